@@ -1,34 +1,304 @@
 import os
+import io
+import math
+import csv
+import json
+import time
+import zlib
+import uuid
 import random
+import atexit
+import hashlib
 import logging
-from datetime import datetime
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session, jsonify
+import sqlite3
+import queue
+import secrets
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from logging.handlers import RotatingFileHandler, WatchedFileHandler, QueueHandler, QueueListener
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
+from flask import g, has_request_context, before_render_template, template_rendered
+from flask.sessions import SessionInterface, SecureCookieSession, SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, or_, and_, select, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import NullPool
 from functools import wraps
-from flask_mail import Mail, Message
+from jinja2 import DictLoader, FileSystemBytecodeCache
+
+# Vercel đặt biến VERCEL=1 cho mỗi function; ở đó filesystem chỉ đọc (trừ /tmp) và không giữ lại giữa các lần chạy
+SERVERLESS = bool(os.environ.get('VERCEL'))
 
 # --- Logging Configuration ---
-logging.basicConfig(filename='app.log', level=logging.INFO,
-                    format='%(asctime)s %(levelname)s: %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+# Xoay vòng file log theo dung lượng để app.log không phình to mãi.
+# LOG_FILE rỗng (mặc định trên Vercel) thì ghi ra stderr; file chỉ được mở khi ghi dòng log đầu tiên.
+LOG_FILE = os.environ.get('LOG_FILE', '' if SERVERLESS else 'app.log')
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# 'size': process tự xoay file (chỉ an toàn khi một process ghi). 'shared': nhiều process cùng ghi và cùng xoay
+# file, khóa bằng flock trên app.log.lock (gunicorn.conf.py bật chế độ này). 'external': chỉ ghi nối đuôi,
+# logrotate bên ngoài đổi tên file và WatchedFileHandler tự mở lại
+LOG_ROTATION = os.environ.get('LOG_ROTATION', 'size')
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# 'text' (mặc định) hoặc 'json': mỗi dòng một object JSON để trang xem log và công cụ ngoài đọc không cần regex
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# Request chỉ đẩy bản ghi vào hàng đợi, một thread riêng format và ghi ra file.
+# Tắt trên serverless vì instance có thể bị đóng băng trước khi thread kịp ghi.
+LOG_ASYNC = os.environ.get('LOG_ASYNC', '0' if SERVERLESS else '1') == '1'
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Các trường truyền qua `extra=` (hoặc tự gắn từ request) được ghi vào log JSON
+LOG_FIELDS = ('draw_id', 'participant_id', 'route', 'method', 'ip', 'latency_ms', 'query_count')
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': self.formatTime(record, LOG_TIME_FORMAT), 'level': record.levelname, 'message': record.getMessage()}
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RequestContextFilter(logging.Filter):
+    """Attach the route, method and client IP of the current request to every record."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.route = getattr(record, 'route', None) or request.endpoint
+            record.method = request.method
+            record.ip = request.remote_addr
+        return True
+
+class DroppingQueueHandler(QueueHandler):
+    """Put records on a bounded queue without blocking; count the ones dropped when it is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Thread ghi log format bản ghi, ở đây giữ nguyên
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that several processes can share: each write and rollover holds an flock on a lock file."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self._lock_path = self.baseFilename + '.lock'
+        self._lock_file = None
+        self._lock_pid = None
+
+    def _interprocess_lock(self):
+        # flock gắn với file descriptor mở ra, fd kế thừa qua fork dùng chung khóa với process cha nên mỗi process tự mở
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(self._lock_path, 'a')
+            self._lock_pid = os.getpid()
+        return self._lock_file
+
+    def _reopen_if_rotated(self):
+        # Process khác vừa xoay file: stream đang trỏ vào app.log.1, mở lại app.log mới
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record):
+        import fcntl
+        lock_file = self._interprocess_lock()
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            self._reopen_if_rotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+if not LOG_FILE:
+    _log_output = logging.StreamHandler()
+elif LOG_ROTATION == 'external':
+    _log_output = WatchedFileHandler(LOG_FILE, encoding='utf-8', delay=True)
+elif LOG_ROTATION == 'shared':
+    _log_output = SharedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                            encoding='utf-8', delay=True)
+else:
+    _log_output = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                      encoding='utf-8', delay=True)
+_log_output.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json'
+                         else logging.Formatter('%(asctime)s %(levelname)s: %(message)s', LOG_TIME_FORMAT))
+log_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE)) if LOG_ASYNC else _log_output
+# Gắn ở handler đầu tiên (chạy trong thread của request) để cả hai chế độ ghi cùng một schema
+log_handler.addFilter(RequestContextFilter())
+logging.basicConfig(handlers=[log_handler], level=logging.INFO)
+
+_log_listener = None
+_log_listener_pid = None
+
+def start_log_listener():
+    """Start this process's log writer thread; call again in every worker after fork."""
+    global _log_listener, _log_listener_pid
+    if not LOG_ASYNC or _log_listener_pid == os.getpid():
+        return
+    if _log_listener_pid is not None:
+        # Sau fork: hàng đợi cũ có thể đang bị khóa bởi thread của process cha và còn bản ghi của nó
+        log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _log_listener = QueueListener(log_handler.queue, _log_output)
+    _log_listener.start()
+    _log_listener_pid = os.getpid()
+
+def stop_log_listener():
+    # Ghi nốt các bản ghi còn trong hàng đợi trước khi process thoát
+    if _log_listener is not None and _log_listener_pid == os.getpid():
+        _log_listener.stop()
+
+start_log_listener()
+atexit.register(stop_log_listener)
+
+# --- Secret Key ---
+# Mọi worker/instance phải dùng chung key thì mới đọc được cookie phiên của nhau.
+# Lấy từ SECRET_KEY (key cũ còn hiệu lực trong SECRET_KEY_FALLBACKS, phân tách bằng dấu phẩy),
+# hoặc từ file SECRET_KEY_FILE: mỗi dòng một key, dòng đầu là key hiện tại. Để xoay key, thêm key mới lên
+# đầu file, đợi các phiên cũ hết hạn rồi xóa các dòng cũ.
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', 'secret_key')
+
+def load_secret_keys():
+    """Return (current key, older keys still accepted), creating the key file on first start."""
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY'], [k for k in os.environ.get('SECRET_KEY_FALLBACKS', '').split(',') if k]
+    if SERVERLESS and not os.path.isfile(SECRET_KEY_FILE):
+        # Mỗi instance tự sinh key riêng thì cookie phiên ký ở instance này bị instance khác từ chối
+        raise RuntimeError('SECRET_KEY is not set: serverless instances cannot share a generated key, '
+                           'set SECRET_KEY in the project environment variables.')
+    try:
+        if not os.path.exists(SECRET_KEY_FILE):
+            # Ghi ra file tạm rồi link sang, các process khởi động cùng lúc sẽ dùng chung key của process thắng
+            tmp_path = f'{SECRET_KEY_FILE}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(secrets.token_hex(32) + '\n')
+            os.chmod(tmp_path, 0o600)
+            try:
+                os.link(tmp_path, SECRET_KEY_FILE)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with open(SECRET_KEY_FILE) as f:
+            keys = [line.strip() for line in f if line.strip()]
+        return keys[0], keys[1:]
+    except (OSError, IndexError) as e:
+        if SERVERLESS:
+            raise RuntimeError(f"Could not read secret key file '{SECRET_KEY_FILE}' and SECRET_KEY is not set.") from e
+        logging.warning(f"Could not read or create secret key file '{SECRET_KEY_FILE}', using a per-process key. Details: {e}")
+        return os.urandom(24).hex(), []
+
+class RotatingKeySessionInterface(SecureCookieSessionInterface):
+    """Flask's cookie session that also accepts cookies signed with SECRET_KEY_FALLBACKS."""
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        # itsdangerous ký bằng key cuối danh sách và thử tất cả key khi kiểm tra
+        return URLSafeTimedSerializer([*reversed(app.config['SECRET_KEY_FALLBACKS']), app.secret_key],
+                                      salt=self.salt, serializer=self.serializer,
+                                      signer_kwargs={'key_derivation': self.key_derivation,
+                                                     'digest_method': self.digest_method})
 
 # --- App Configuration ---
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///lottery.db'
+# Số reverse proxy tin cậy đứng trước app; chỉ khi > 0 mới lấy IP client từ X-Forwarded-For
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 1 if SERVERLESS else 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+app.config['SECRET_KEY'], app.config['SECRET_KEY_FALLBACKS'] = load_secret_keys()
+app.session_interface = RotatingKeySessionInterface()
+# File SQLite trên serverless chỉ sống cùng instance; muốn giữ dữ liệu hãy trỏ DATABASE_URL tới một database bên ngoài
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:////tmp/lottery.db' if SERVERLESS else 'sqlite:///lottery.db')
+if DATABASE_URL.startswith('postgres://'):
+    # Nhiều nhà cung cấp Postgres vẫn trả về scheme cũ mà SQLAlchemy không còn nhận
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# --- SQLite Tuning (tắt bằng SQLITE_TUNING=0) ---
+# WAL cho phép đọc song song với ghi, busy_timeout để các request ghi chờ nhau thay vì lỗi "database is locked"
+SQLITE_TUNING = os.environ.get('SQLITE_TUNING', '1') != '0'
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': SQLITE_BUSY_TIMEOUT_MS,
+    'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', 20000)),  # số âm = đơn vị KiB
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+} if SQLITE_TUNING else {}
+if DATABASE_URL.startswith('sqlite'):
+    if SQLITE_TUNING:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.environ.get('SQLITE_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('SQLITE_MAX_OVERFLOW', 20)),
+            'pool_timeout': 30,
+            'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000},
+        }
+elif os.environ.get('DB_POOL') == 'null':
+    # Đứng sau một connection pooler bên ngoài (pgbouncer, Neon/Supabase pooler): mở connection mới cho mỗi lần dùng
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': NullPool}
+else:
+    # Serverless: mỗi instance chỉ xử lý một request một lúc, giữ một connection để dùng lại khi instance còn ấm.
+    # pre_ping/recycle vì connection có thể đã bị database đóng trong lúc instance bị đóng băng.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 1 if SERVERLESS else 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 0 if SERVERLESS else 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 300)),
+        'pool_pre_ping': True,
+    }
+
 # --- Mail Configuration (sẽ được cập nhật từ DB) ---
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
 app.config['MAIL_USE_TLS'] = True
-# Các giá trị này sẽ được load từ DB trong hàm `update_mail_config`
+# Các giá trị này sẽ được load từ DB qua `settings_cache` (xem `update_mail_config`)
 app.config['MAIL_USERNAME'] = None
 app.config['MAIL_PASSWORD'] = None
 app.config['MAIL_DEFAULT_SENDER'] = None
 
 db = SQLAlchemy(app)
-mail = Mail(app)
+# Flask-Mail (kéo theo smtplib/email) chỉ được import ở lần gửi mail đầu tiên, xem `get_mail`
+_mail = None
+
+def get_mail():
+    global _mail
+    if _mail is None:
+        from flask_mail import Mail
+        _mail = Mail(app)
+    return _mail
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
 
 # --- Admin Credentials (for demonstration purposes) ---
 ADMIN_USERNAME = 'admin'
@@ -46,12 +316,25 @@ class Draw(db.Model):
     winner_id = db.Column(db.Integer, db.ForeignKey('participant.id'), nullable=True)
     winning_number = db.Column(db.String(10), nullable=True)
     winner_email_content = db.Column(db.Text, nullable=True)
+    prize_count = db.Column(db.Integer, nullable=False, default=1)
+    # Khóa hoán vị và bộ đếm dùng để cấp số may mắn (xem `allocate_lucky_number`)
+    number_key = db.Column(db.String(32), nullable=False, default=lambda: os.urandom(16).hex())
+    numbers_issued = db.Column(db.Integer, nullable=False, default=0)
+    # Đợt quay có số may mắn cấp ngẫu nhiên từ trước khi có bộ đếm: phải bỏ qua các số đã có chủ
+    legacy_numbers = db.Column(db.Boolean, nullable=False, default=False)
+    # Việc dọn dẹp đang chờ worker nền: 'delete' hoặc 'archive' (xem `run_draw_cleanup`)
+    cleanup_action = db.Column(db.String(10), nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=True)
     participants = db.relationship('Participant', backref='draw', lazy=True, foreign_keys='Participant.draw_id', cascade="all, delete-orphan")
     winner = db.relationship('Participant', foreign_keys=[winner_id], post_update=True)
+    winners = db.relationship('Winner', backref='draw', lazy=True, order_by='Winner.rank', cascade="all, delete-orphan")
+    outbox_messages = db.relationship('OutboxMessage', backref='draw', lazy=True, cascade="all, delete-orphan")
+    announcements = db.relationship('Announcement', backref='draw', lazy=True, cascade="all, delete-orphan")
 
     @property
     def status(self):
-        if self.winner:
+        # Dùng winner_id để không phải load quan hệ `winner`
+        if self.winner_id is not None:
             return 'Đã kết thúc'
         if datetime.now() > self.draw_date:
             return 'Đang quay số'
@@ -64,10 +347,148 @@ class Participant(db.Model):
     email = db.Column(db.String(100), nullable=False)
     lucky_number = db.Column(db.String(10), nullable=False)
     ip_address = db.Column(db.String(45))
-    draw_id = db.Column(db.Integer, db.ForeignKey('draw.id'), nullable=False)
+    draw_id = db.Column(db.Integer, db.ForeignKey('draw.id'), nullable=False, index=True)
     __table_args__ = (db.UniqueConstraint('email', 'draw_id', name='_email_draw_uc'),
-                      db.UniqueConstraint('phone', 'draw_id', name='_phone_draw_uc'))
+                      db.UniqueConstraint('phone', 'draw_id', name='_phone_draw_uc'),
+                      db.Index('uq_participant_draw_lucky_number', 'draw_id', 'lucky_number', unique=True),
+                      db.Index('ix_participant_draw_ip', 'draw_id', 'ip_address'))
 
+class Winner(db.Model):
+    # Danh sách người thắng của đợt quay; giải nhất (rank 1) cũng được ghi vào Draw.winner_id
+    id = db.Column(db.Integer, primary_key=True)
+    draw_id = db.Column(db.Integer, db.ForeignKey('draw.id'), nullable=False, index=True)
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    participant = db.relationship('Participant')
+    __table_args__ = (db.UniqueConstraint('draw_id', 'rank', name='_draw_rank_uc'),
+                      db.UniqueConstraint('draw_id', 'participant_id', name='_draw_participant_uc'))
+
+class Announcement(db.Model):
+    # Email thông báo hàng loạt tới mọi người tham gia; last_participant_id là con trỏ để gửi tiếp sau khi khởi động lại
+    id = db.Column(db.Integer, primary_key=True)
+    draw_id = db.Column(db.Integer, db.ForeignKey('draw.id'), nullable=False, index=True)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    rate_per_minute = db.Column(db.Integer, nullable=False, default=1200)
+    status = db.Column(db.String(10), nullable=False, default='pending', index=True)  # pending / running / done
+    total_recipients = db.Column(db.Integer, nullable=False, default=0)
+    last_participant_id = db.Column(db.Integer, nullable=False, default=0)
+    sent_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    claim_token = db.Column(db.String(32), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class OutboxMessage(db.Model):
+    # Hàng đợi email: request chỉ ghi vào bảng này, worker nền sẽ gửi (xem `process_outbox`)
+    id = db.Column(db.Integer, primary_key=True)
+    draw_id = db.Column(db.Integer, db.ForeignKey('draw.id'), nullable=True, index=True)
+    recipient = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending', index=True)  # pending / sending / sent / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    claim_token = db.Column(db.String(32), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+class ParticipantArchive(db.Model):
+    # Người tham gia của đợt đã lưu trữ: mỗi dòng là một khối NDJSON nén gzip, nối các khối lại là một file .ndjson.gz hợp lệ
+    id = db.Column(db.Integer, primary_key=True)
+    draw_id = db.Column(db.Integer, db.ForeignKey('draw.id'), nullable=False, index=True)
+    last_participant_id = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+class Lease(db.Model):
+    # Khóa có thời hạn trong DB, để chỉ một worker trong số nhiều process làm một việc nền (xem `acquire_lease`)
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class ServerSession(db.Model):
+    # Phiên lưu phía server khi SESSION_BACKEND=db; cookie chỉ chứa id ngẫu nhiên
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# --- Phiên phía server (bật bằng SESSION_BACKEND=db) ---
+# Mặc định phiên nằm trong cookie ký bằng SECRET_KEY; với 'db' mọi worker/instance đọc phiên từ database dùng chung
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'cookie')
+SESSION_PRUNE_EVERY = 1000
+
+class DatabaseSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.stale_sid = None
+
+    def regenerate(self):
+        """Switch to a fresh session id (on login) so that a leaked old id stops working."""
+        if self.sid:
+            self.stale_sid, self.sid = self.sid, None
+        self.modified = True
+
+class DatabaseSessionInterface(SessionInterface):
+    """Store sessions in the server_session table, keyed by a random id in the cookie."""
+    serializer = SecureCookieSessionInterface.serializer
+    session_class = DatabaseSession
+
+    def __init__(self):
+        self._saves = 0
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            # Connection riêng: không commit/rollback nhầm db.session của view
+            with db.engine.connect() as conn:
+                data = conn.execute(select(ServerSession.data).where(
+                    ServerSession.id == sid, ServerSession.expires_at > datetime.now())).scalar()
+            if data is not None:
+                return self.session_class(self.serializer.loads(data), sid=sid)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        table = ServerSession.__table__
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session:
+            if session.modified:
+                with db.engine.begin() as conn:
+                    conn.execute(table.delete().where(table.c.id.in_([session.sid, session.stale_sid])))
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+
+        sid = session.sid or secrets.token_urlsafe(32)
+        self._saves += 1
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.id.in_([sid, session.stale_sid])))
+            conn.execute(table.insert().values(id=sid, data=self.serializer.dumps(dict(session)),
+                                               expires_at=datetime.now() + app.permanent_session_lifetime))
+            if self._saves % SESSION_PRUNE_EVERY == 0:
+                conn.execute(table.delete().where(table.c.expires_at < datetime.now()))
+        expires = self.get_expiration_time(app, session)
+        response.set_cookie(name, sid, expires=expires, httponly=httponly, domain=domain, path=path,
+                            secure=secure, samesite=samesite)
+        response.vary.add('Cookie')
+
+if SESSION_BACKEND == 'db':
+    app.session_interface = DatabaseSessionInterface()
 
 # --- Các mẫu HTML (Templates) ---
 # Sử dụng Bootstrap 5 cho giao diện đẹp và nhanh chóng
@@ -129,7 +550,8 @@ TPL_BASE = """
 </html>
 """
 
-TPL_INDEX = TPL_BASE.replace('{% block content %}{% endblock %}', """
+TPL_INDEX = """{% extends 'base.html' %}
+{% block content %}
 <div class="text-center mb-5">
     <h1>Các Đợt Quay Số</h1>
     <p class="lead">Tham gia ngay để có cơ hội nhận VPS miễn phí hàng tháng!</p>
@@ -142,18 +564,19 @@ TPL_INDEX = TPL_BASE.replace('{% block content %}{% endblock %}', """
                 <h5 class="card-title">{{ draw.prize_name }}</h5>
                 <p class="card-text text-muted">Ngày quay: {{ draw.draw_date.strftime('%d/%m/%Y lúc %H:%M') }}</p>
                 <div class="mt-auto">
+                    {% set status = draw.status %}
                     <span class="badge status-badge 
-                        {% if draw.status == 'Sắp diễn ra' %}status-sap-dien-ra
-                        {% elif draw.status == 'Đã kết thúc' %}status-da-ket-thuc
-                        {% elif draw.status == 'Đang quay số' %}status-dang-quay-so
+                        {% if status == 'Sắp diễn ra' %}status-sap-dien-ra
+                        {% elif status == 'Đã kết thúc' %}status-da-ket-thuc
+                        {% elif status == 'Đang quay số' %}status-dang-quay-so
                         {% endif %}">
-                        {{ draw.status }}
+                        {{ status }}
                     </span>
-                    {% if draw.status == 'Sắp diễn ra' %}
+                    {% if status == 'Sắp diễn ra' %}
                         <a href="{{ url_for('register', draw_id=draw.id) }}" class="btn btn-primary float-end">Đăng Ký</a>
-                    {% elif draw.status == 'Đang quay số' %}
+                    {% elif status == 'Đang quay số' %}
                          <a href="{{ url_for('spin', draw_id=draw.id) }}" class="btn btn-danger float-end">Xem Quay Số</a>
-                    {% elif draw.status == 'Đã kết thúc' and draw.winner %}
+                    {% elif status == 'Đã kết thúc' and draw.winner %}
                         <p class="mt-2 mb-0">Chúc mừng: <strong>{{ draw.winner.full_name }}</strong></p>
                         <p class="mb-0">Số may mắn: <strong>{{ draw.winning_number }}</strong></p>
                     {% endif %}
@@ -167,9 +590,12 @@ TPL_INDEX = TPL_BASE.replace('{% block content %}{% endblock %}', """
     </div>
     {% endfor %}
 </div>
-""")
+{% endblock %}
+"""
 
-TPL_REGISTER = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Đăng Ký Tham Gia').replace('{% block content %}{% endblock %}', """
+TPL_REGISTER = """{% extends 'base.html' %}
+{% block title %}Đăng Ký Tham Gia{% endblock %}
+{% block content %}
 <div class="row justify-content-center">
     <div class="col-md-6">
         <div class="card">
@@ -197,9 +623,12 @@ TPL_REGISTER = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock
         </div>
     </div>
 </div>
-""")
+{% endblock %}
+"""
 
-TPL_THANK_YOU = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Đăng Ký Thành Công').replace('{% block content %}{% endblock %}', """
+TPL_THANK_YOU = """{% extends 'base.html' %}
+{% block title %}Đăng Ký Thành Công{% endblock %}
+{% block content %}
 <div class="text-center">
     <div class="card mx-auto" style="max-width: 400px;">
         <div class="card-body">
@@ -210,9 +639,11 @@ TPL_THANK_YOU = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endbloc
         </div>
     </div>
 </div>
-""")
+{% endblock %}
+"""
 
-TPL_SPIN_PAGE = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Vòng Quay May Mắn').replace('{% block content %}{% endblock %}', """
+TPL_SPIN_PAGE = """{% extends 'base.html' %}
+{% block title %}Vòng Quay May Mắn{% endblock %}
 {% block content %}
 <div class="container text-center">
     <h1>Vòng Quay May Mắn - {{ draw.prize_name }}</h1>
@@ -227,12 +658,15 @@ TPL_SPIN_PAGE = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endbloc
         <p>Số may mắn là: <strong id="winning-number" class="fs-3"></strong></p>
         <p>Họ tên: <strong id="winner-name"></strong></p>
         <p>Số điện thoại: <strong id="winner-phone"></strong></p>
+        <div id="winner-list-box" class="d-none mx-auto" style="max-width: 600px;">
+            <h4>Danh sách người thắng giải</h4>
+            <ol id="winner-list" class="list-group list-group-numbered text-start"></ol>
+        </div>
         <p class="text-success">Vui lòng kiểm tra email để nhận thông tin giải thưởng!</p>
         <a href="{{ url_for('index') }}" class="btn btn-primary mt-3">Xem các đợt quay khác</a>
     </div>
 </div>
 {% endblock %}
-""").replace('{% block scripts %}{% endblock %}', """
 {% block scripts %}
 <script>
     document.addEventListener('DOMContentLoaded', function() {
@@ -256,6 +690,17 @@ TPL_SPIN_PAGE = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endbloc
             document.getElementById('winner-name').textContent = winnerData.winner_name;
             document.getElementById('winner-phone').textContent = winnerData.winner_phone;
 
+            if (winnerData.winners && winnerData.winners.length > 1) {
+                const list = document.getElementById('winner-list');
+                winnerData.winners.forEach(w => {
+                    const item = document.createElement('li');
+                    item.className = 'list-group-item';
+                    item.textContent = `${w.winner_name} - ${w.winner_phone} (Số: ${w.winning_number})`;
+                    list.appendChild(item);
+                });
+                document.getElementById('winner-list-box').classList.remove('d-none');
+            }
+
             wheelDiv.classList.add('d-none');
             resultDiv.classList.remove('d-none');
         }
@@ -267,6 +712,11 @@ TPL_SPIN_PAGE = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endbloc
             window.location.href = "{{ url_for('index') }}";
         }
 
+        function showWinnerAfterPause(data) {
+            // Đợi một chút để người dùng thấy số trúng thưởng cuối cùng
+            setTimeout(() => stopSpinningAndShowWinner(data), 1000);
+        }
+
         function fetchWinner() {
             fetch("{{ url_for('get_winner', draw_id=draw.id) }}")
                 .then(response => response.json())
@@ -274,8 +724,7 @@ TPL_SPIN_PAGE = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endbloc
                     if (data.error) {
                         handleNoWinner();
                     } else {
-                        // Đợi một chút để người dùng thấy số trúng thưởng cuối cùng
-                        setTimeout(() => stopSpinningAndShowWinner(data), 1000);
+                        showWinnerAfterPause(data);
                     }
                 })
                 .catch(error => {
@@ -284,17 +733,46 @@ TPL_SPIN_PAGE = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endbloc
                 });
         }
 
+        // Dự phòng khi không dùng được SSE: quay 5 giây rồi gọi API lấy người thắng cuộc
+        function pollForWinner() {
+            setTimeout(fetchWinner, 5000);
+        }
+
         // Bắt đầu quay ngay lập tức
         startSpinning();
 
-        // Sau 5 giây, gọi API để lấy người thắng cuộc
-        setTimeout(fetchWinner, 5000); // Quay trong 5 giây
+        if (!window.EventSource) {
+            pollForWinner();
+            return;
+        }
+
+        // Máy chủ phát cùng một thời điểm bắt đầu và kết quả cho mọi người đang xem
+        let finished = false;
+        const events = new EventSource("{{ url_for('spin_events', draw_id=draw.id) }}");
+        events.addEventListener('winner', e => {
+            finished = true;
+            events.close();
+            showWinnerAfterPause(JSON.parse(e.data));
+        });
+        events.addEventListener('no_winner', () => {
+            finished = true;
+            events.close();
+            handleNoWinner();
+        });
+        events.onerror = () => {
+            // EventSource tự kết nối lại; chỉ chuyển sang polling khi máy chủ từ chối hẳn
+            if (!finished && events.readyState === EventSource.CLOSED) {
+                finished = true;
+                pollForWinner();
+            }
+        };
     });
 </script>
 {% endblock %}
-""")
+"""
 # --- Mẫu HTML cho trang quản trị ---
-TPL_LOGIN = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Đăng Nhập Quản Trị').replace('{% block content %}{% endblock %}', """
+TPL_LOGIN = """{% extends 'base.html' %}
+{% block title %}Đăng Nhập Quản Trị{% endblock %}
 {% block content %}
 <div class="row justify-content-center mt-5">
     <div class="col-md-4">
@@ -319,9 +797,11 @@ TPL_LOGIN = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}
     </div>
 </div>
 {% endblock %}
-""")
+"""
 
-TPL_ADMIN_DASHBOARD = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Bảng Điều Khiển').replace('{% block content %}{% endblock %}', """
+TPL_ADMIN_DASHBOARD = """{% extends 'base.html' %}
+{% block title %}Bảng Điều Khiển{% endblock %}
+{% block content %}
 <div class="d-flex justify-content-between align-items-center mb-4">
     <h1>Bảng Điều Khiển</h1>
     <div>
@@ -344,10 +824,14 @@ TPL_ADMIN_DASHBOARD = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% e
                     <label for="draw_date" class="form-label">Ngày Quay</label>
                     <input type="date" class="form-control" id="draw_date" name="draw_date" required>
                 </div>
-                <div class="col-md-3">
+                <div class="col-md-2">
                     <label for="draw_time" class="form-label">Giờ Quay</label>
                     <input type="time" class="form-control" id="draw_time" name="draw_time" required>
                 </div>
+                <div class="col-md-1">
+                    <label for="prize_count" class="form-label">Số Giải</label>
+                    <input type="number" class="form-control" id="prize_count" name="prize_count" min="1" value="1" required>
+                </div>
                 <div class="col-12">
                     <label for="winner_email_content" class="form-label">Nội dung Email cho người trúng (Tùy chọn)</label>
                     <textarea class="form-control" id="winner_email_content" name="winner_email_content" rows="3" placeholder="Sử dụng các biến: {{full_name}}, {{phone}}, {{email}}, {{prize_name}}, {{lucky_number}}. Ví dụ: Chúc mừng {{full_name}} đã trúng giải {{prize_name}}. Chúng tôi sẽ liên hệ với bạn qua SĐT {{phone}} để trao giải."></textarea>
@@ -370,6 +854,7 @@ TPL_ADMIN_DASHBOARD = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% e
                 <tr>
                     <th>ID</th>
                     <th>Giải Thưởng</th>
+                    <th>Số Giải</th>
                     <th>Ngày Quay</th>
                     <th>Trạng Thái</th>
                     <th>Số người tham gia</th>
@@ -381,15 +866,22 @@ TPL_ADMIN_DASHBOARD = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% e
                 <tr>
                     <td>{{ draw.id }}</td>
                     <td>{{ draw.prize_name }}</td>
+                    <td>{{ draw.prize_count }}</td>
                     <td>{{ draw.draw_date.strftime('%d/%m/%Y %H:%M') }}</td>
+                    {% set status = draw.status %}
                     <td><span class="badge 
-                        {% if draw.status == 'Sắp diễn ra' %}bg-warning text-dark
-                        {% elif draw.status == 'Đã kết thúc' %}bg-secondary
-                        {% else %}bg-danger{% endif %}">{{ draw.status }}</span>
+                        {% if status == 'Sắp diễn ra' %}bg-warning text-dark
+                        {% elif status == 'Đã kết thúc' %}bg-secondary
+                        {% else %}bg-danger{% endif %}">{{ status }}</span>
                     </td>
-                    <td>{{ draw.participants|length }}</td>
+                    <td>{{ participant_counts.get(draw.id, 0) }}</td>
                     <td>
                         <a href="{{ url_for('view_participants', draw_id=draw.id) }}" class="btn btn-sm btn-info">Xem DS</a>
+                        {% if draw.cleanup_action == 'archive' %}
+                        <span class="badge bg-light text-dark">Đang lưu trữ...</span>
+                        {% elif status == 'Đã kết thúc' and not draw.archived_at %}
+                        <a href="{{ url_for('archive_draw', draw_id=draw.id) }}" class="btn btn-sm btn-outline-secondary" onclick="return confirm('Chuyển danh sách người tham gia của đợt này vào kho lưu trữ nén?');">Lưu trữ</a>
+                        {% endif %}
                         <a href="{{ url_for('delete_draw', draw_id=draw.id) }}" class="btn btn-sm btn-danger" onclick="return confirm('Bạn có chắc chắn muốn xóa đợt quay số này không? Thao tác này sẽ xóa cả người tham gia.');">Xóa</a>
                     </td>
                 </tr>
@@ -398,33 +890,151 @@ TPL_ADMIN_DASHBOARD = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% e
         </table>
     </div>
 </div>
-""")
+{% endblock %}
+"""
 
-TPL_ADMIN_PARTICIPANTS = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Danh Sách Tham Gia').replace('{% block content %}{% endblock %}', """
+TPL_ADMIN_PARTICIPANTS = """{% extends 'base.html' %}
+{% block title %}Danh Sách Tham Gia{% endblock %}
+{% block content %}
 <div class="d-flex justify-content-between align-items-center mb-4">
     <div>
         <h1>Danh sách tham gia - {{ draw.prize_name }}</h1>
-        {% if draw.winner %}
-            <p class="lead">Người thắng cuộc: <strong>{{ draw.winner.full_name }}</strong> (SĐT: {{ draw.winner.phone }}, Email: {{ draw.winner.email }})</p>
+        {% if winners|length == 1 %}
+            <p class="lead">Người thắng cuộc: <strong>{{ winners[0].full_name }}</strong> (SĐT: {{ winners[0].phone }}, Email: {{ winners[0].email }})</p>
+        {% elif winners %}
+            <p class="lead mb-1">Người thắng cuộc ({{ winners|length }} giải):</p>
+            <ol>
+            {% for w in winners %}
+                <li><strong>{{ w.full_name }}</strong> (SĐT: {{ w.phone }}, Email: {{ w.email }}, Số: {{ w.lucky_number }})</li>
+            {% endfor %}
+            </ol>
         {% endif %}
     </div>
-    <a href="{{ url_for('admin_dashboard') }}" class="btn btn-secondary align-self-start">Quay lại</a>
+    <div class="align-self-start">
+        <div class="btn-group me-2">
+            <a href="{{ url_for('export_participants', draw_id=draw.id, format='csv') }}" class="btn btn-outline-primary">Xuất CSV</a>
+            <a href="{{ url_for('export_participants', draw_id=draw.id, format='csv', gzip=1) }}" class="btn btn-outline-primary">CSV (gzip)</a>
+            <a href="{{ url_for('export_participants', draw_id=draw.id, format='ndjson') }}" class="btn btn-outline-primary">NDJSON</a>
+        </div>
+        <a href="{{ url_for('admin_dashboard') }}" class="btn btn-secondary">Quay lại</a>
+    </div>
 </div>
 
+{% if draw.archived_at %}
+<div class="alert alert-secondary">Danh sách người tham gia đã được lưu trữ lúc {{ draw.archived_at.strftime('%d/%m/%Y %H:%M') }}, chỉ còn người thắng cuộc hiển thị ở đây. Dùng nút xuất để tải toàn bộ danh sách.</div>
+{% endif %}
+
 {% if draw.winner and draw.winner_email_content %}
 <div class="card mb-4">
     <div class="card-body d-flex justify-content-between align-items-center">
-        <span>Gửi email thông báo cho người thắng cuộc.</span>
+        <span>Gửi email thông báo cho {{ 'các ' if winners|length > 1 }}người thắng cuộc.</span>
         <a href="{{ url_for('send_winner_email', draw_id=draw.id) }}" class="btn btn-success">Gửi Email Ngay</a>
     </div>
 </div>
 {% endif %}
 
+<div class="card mb-4">
+    <div class="card-header">Gửi thông báo tới tất cả người tham gia</div>
+    <div class="card-body">
+        <form action="{{ url_for('create_announcement', draw_id=draw.id) }}" method="POST" class="row g-2">
+            <div class="col-md-9">
+                <input type="text" class="form-control" name="subject" placeholder="Tiêu đề" value="Kết quả quay số {{ draw.prize_name }}" required>
+            </div>
+            <div class="col-md-3">
+                <div class="input-group">
+                    <input type="number" class="form-control" name="rate_per_minute" min="1" value="1200" required>
+                    <span class="input-group-text">email/phút</span>
+                </div>
+            </div>
+            <div class="col-12">
+                <textarea class="form-control" name="body" rows="3" required placeholder="Sử dụng các biến: {{ '{{full_name}}' }}, {{ '{{phone}}' }}, {{ '{{email}}' }}, {{ '{{prize_name}}' }}, {{ '{{lucky_number}}' }}."></textarea>
+            </div>
+            <div class="col-12">
+                <button type="submit" class="btn btn-warning" onclick="return confirm('Gửi email tới tất cả người tham gia của đợt quay này?');">Gửi Thông Báo</button>
+            </div>
+        </form>
+        {% if announcements %}
+        <table class="table table-sm mt-3 mb-0">
+            <thead>
+                <tr>
+                    <th>Tiêu đề</th>
+                    <th>Trạng thái</th>
+                    <th>Tiến độ</th>
+                    <th>Lỗi</th>
+                    <th>Tạo lúc</th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for a in announcements %}
+                <tr>
+                    <td>{{ a.subject }}</td>
+                    <td>{{ a.status }}</td>
+                    <td>{{ a.sent_count }} / {{ a.total_recipients }}</td>
+                    <td>{{ a.failed_count }}</td>
+                    <td>{{ a.created_at.strftime('%d/%m/%Y %H:%M') }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        {% endif %}
+    </div>
+</div>
+
+{% if mail_messages %}
+<div class="card mb-4">
+    <div class="card-header">Trạng thái gửi email</div>
+    <div class="card-body">
+        <table class="table table-sm">
+            <thead>
+                <tr>
+                    <th>Người nhận</th>
+                    <th>Trạng thái</th>
+                    <th>Số lần thử</th>
+                    <th>Thời gian</th>
+                    <th>Lỗi gần nhất</th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for m in mail_messages %}
+                <tr>
+                    <td>{{ m.recipient }}</td>
+                    <td><span class="badge
+                        {% if m.status == 'sent' %}bg-success
+                        {% elif m.status == 'failed' %}bg-danger
+                        {% else %}bg-warning text-dark{% endif %}">{{ m.status }}</span></td>
+                    <td>{{ m.attempts }}</td>
+                    <td>{{ (m.sent_at or m.next_attempt_at).strftime('%d/%m/%Y %H:%M:%S') }}</td>
+                    <td class="text-muted small">{{ m.last_error or '' }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    </div>
+</div>
+{% endif %}
+
 <div class="card">
     <div class="card-body">
+        <form method="GET" class="row g-2 mb-3">
+            <div class="col-md-6">
+                <input type="text" class="form-control" name="q" value="{{ q }}" placeholder="Tìm theo SĐT, email hoặc số may mắn">
+            </div>
+            <div class="col-md-2">
+                <select class="form-select" name="per_page">
+                    {% for size in PARTICIPANT_PAGE_SIZES %}
+                    <option value="{{ size }}" {{ 'selected' if size == per_page }}>{{ size }} / trang</option>
+                    {% endfor %}
+                </select>
+            </div>
+            <div class="col-md-4">
+                <button type="submit" class="btn btn-primary">Tìm</button>
+                {% if q %}<a href="{{ url_for('view_participants', draw_id=draw.id, per_page=per_page) }}" class="btn btn-outline-secondary">Xóa lọc</a>{% endif %}
+            </div>
+        </form>
         <table class="table table-hover">
             <thead>
                 <tr>
+                    <th>ID</th>
                     <th>Họ Tên</th>
                     <th>Email</th>
                     <th>SĐT</th>
@@ -434,21 +1044,35 @@ TPL_ADMIN_PARTICIPANTS = TPL_BASE.replace('{% block title %}Quay Số May Mắn{
             </thead>
             <tbody>
                 {% for p in participants %}
-                <tr class="{{ 'winner-row' if p.id == draw.winner_id }}">
+                <tr class="{{ 'winner-row' if p.id in winner_ids }}">
+                    <td>{{ p.id }}</td>
                     <td>{{ p.full_name }}</td>
                     <td>{{ p.email }}</td>
                     <td>{{ p.phone }}</td>
                     <td>{{ p.lucky_number }}</td>
                     <td>{{ p.ip_address }}</td>
                 </tr>
+                {% else %}
+                <tr><td colspan="6" class="text-center text-muted">Không tìm thấy người tham gia nào.</td></tr>
                 {% endfor %}
             </tbody>
         </table>
+        <nav class="d-flex justify-content-between">
+            {% if prev_before %}
+            <a href="{{ url_for('view_participants', draw_id=draw.id, q=q or None, per_page=per_page, before=prev_before) }}" class="btn btn-outline-primary">&laquo; Trang trước</a>
+            {% else %}<span></span>{% endif %}
+            {% if next_after %}
+            <a href="{{ url_for('view_participants', draw_id=draw.id, q=q or None, per_page=per_page, after=next_after) }}" class="btn btn-outline-primary">Trang sau &raquo;</a>
+            {% endif %}
+        </nav>
     </div>
 </div>
-""")
+{% endblock %}
+"""
 
-TPL_ADMIN_SETTINGS = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Cài Đặt').replace('{% block content %}{% endblock %}', """
+TPL_ADMIN_SETTINGS = """{% extends 'base.html' %}
+{% block title %}Cài Đặt{% endblock %}
+{% block content %}
 <div class="row justify-content-center">
     <div class="col-md-8">
         <div class="card">
@@ -473,15 +1097,35 @@ TPL_ADMIN_SETTINGS = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% en
         </div>
     </div>
 </div>
-""")
+{% endblock %}
+"""
 
-TPL_LOGS = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}', 'Logs Hệ Thống').replace('{% block content %}{% endblock %}', """
+TPL_LOGS = """{% extends 'base.html' %}
+{% block title %}Logs Hệ Thống{% endblock %}
+{% block content %}
 <div class="d-flex justify-content-between align-items-center mb-4">
     <h1>Logs Hệ Thống</h1>
     <a href="{{ url_for('admin_dashboard') }}" class="btn btn-secondary">Quay lại</a>
 </div>
 <div class="card">
     <div class="card-body">
+        <form method="GET" class="row g-2 mb-3">
+            <div class="col-md-2">
+                <select class="form-select" name="level">
+                    <option value="">Tất cả mức</option>
+                    {% for lv in LOG_LEVELS %}
+                    <option value="{{ lv }}" {{ 'selected' if lv == level }}>{{ lv }}</option>
+                    {% endfor %}
+                </select>
+            </div>
+            <div class="col-md-6">
+                <input type="text" class="form-control" name="q" value="{{ q }}" placeholder="Lọc theo nội dung">
+            </div>
+            <div class="col-md-4">
+                <button type="submit" class="btn btn-primary">Lọc</button>
+                <a href="{{ url_for('view_logs') }}" class="btn btn-outline-secondary">Mới nhất</a>
+            </div>
+        </form>
         <pre style="white-space: pre-wrap; word-wrap: break-word;">
         {% for line in log_lines %}
             {% if 'ERROR' in line %}
@@ -493,26 +1137,1311 @@ TPL_LOGS = TPL_BASE.replace('{% block title %}Quay Số May Mắn{% endblock %}'
             <p>Chưa có log nào.</p>
         {% endfor %}
         </pre>
+        {% if next_before %}
+        <a href="{{ url_for('view_logs', level=level or None, q=q or None, before=next_before) }}" class="btn btn-outline-primary">Log cũ hơn &raquo;</a>
+        {% endif %}
     </div>
 </div>
-""")
+{% endblock %}
+"""
+
+# Đăng ký template một lần lúc khởi động: Jinja biên dịch mỗi template một lần cho mỗi process
+# (và dùng lại bytecode trên đĩa nếu có TEMPLATE_CACHE_DIR) thay vì parse lại ở mỗi request.
+TEMPLATES = {
+    'base.html': TPL_BASE,
+    'index.html': TPL_INDEX,
+    'register.html': TPL_REGISTER,
+    'thank_you.html': TPL_THANK_YOU,
+    'spin.html': TPL_SPIN_PAGE,
+    'login.html': TPL_LOGIN,
+    'admin/dashboard.html': TPL_ADMIN_DASHBOARD,
+    'admin/participants.html': TPL_ADMIN_PARTICIPANTS,
+    'admin/settings.html': TPL_ADMIN_SETTINGS,
+    'admin/logs.html': TPL_LOGS,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+if os.environ.get('TEMPLATE_CACHE_DIR'):
+    os.makedirs(os.environ['TEMPLATE_CACHE_DIR'], exist_ok=True)
+    app.jinja_options = {**app.jinja_options,
+                         'bytecode_cache': FileSystemBytecodeCache(os.environ['TEMPLATE_CACHE_DIR'])}
 
 
 # --- Helper Functions ---
+PARTICIPANT_PAGE_SIZES = (50, 100, 200, 500)
+
 @app.context_processor
 def inject_now():
     return {'now': datetime.now()}
 
+# Đợt quay đang chờ xóa coi như không còn tồn tại; đợt đã lưu trữ vẫn hiển thị kết quả như thường
+DRAW_NOT_DELETED = or_(Draw.cleanup_action.is_(None), Draw.cleanup_action != 'delete')
+
+def get_draw_or_404(draw_id):
+    return Draw.query.filter(Draw.id == draw_id, DRAW_NOT_DELETED).first_or_404()
+
+# Số may mắn nằm trong khoảng 10000..99999, tức 90000 = 300 * 300 giá trị.
+LUCKY_NUMBER_MIN = 10000
+LUCKY_NUMBER_SPACE = 90000
+_FEISTEL_HALF = 300
+_FEISTEL_ROUNDS = 4
+
+def _permute_lucky_index(key, index):
+    """Keyed Feistel permutation of [0, LUCKY_NUMBER_SPACE); bijective for any key."""
+    left, right = divmod(index, _FEISTEL_HALF)
+    for rnd in range(_FEISTEL_ROUNDS):
+        digest = hashlib.blake2b(f'{rnd}:{right}'.encode(), key=key, digest_size=4).digest()
+        left, right = right, (left + int.from_bytes(digest, 'big')) % _FEISTEL_HALF
+    return left * _FEISTEL_HALF + right
+
+def allocate_lucky_numbers(draw, count):
+    """Hand out the next `count` lucky numbers of a draw; fewer when the draw is nearly full."""
+    # Tăng bộ đếm trong transaction của người gọi: đăng ký bị rollback cũng trả lại số đã cấp
+    issued = Draw.query.filter(Draw.id == draw.id, Draw.numbers_issued + count <= LUCKY_NUMBER_SPACE) \
+        .update({Draw.numbers_issued: Draw.numbers_issued + count}, synchronize_session=False)
+    if not issued:
+        # Không đủ cho cả lô: cấp từng số cho tới khi hết
+        numbers = []
+        while len(numbers) < count and count > 1:
+            number = allocate_lucky_number(draw)
+            if number is None:
+                break
+            numbers.append(number)
+        return numbers
+    end = db.session.query(Draw.numbers_issued).filter(Draw.id == draw.id).scalar()
+    key = bytes.fromhex(draw.number_key)
+    numbers = [str(LUCKY_NUMBER_MIN + _permute_lucky_index(key, index)) for index in range(end - count, end)]
+    if draw.legacy_numbers:
+        # Số này đã được cấp ngẫu nhiên trước khi nâng cấp: bỏ qua và cấp số kế tiếp
+        taken = {number for number, in db.session.query(Participant.lucky_number).filter(
+            Participant.draw_id == draw.id, Participant.lucky_number.in_(numbers))}
+        if taken:
+            numbers = [number for number in numbers if number not in taken] + allocate_lucky_numbers(draw, len(taken))
+    return numbers
+
+def allocate_lucky_number(draw):
+    """Hand out the next lucky number of a draw in O(1); None when the draw is full."""
+    numbers = allocate_lucky_numbers(draw, 1)
+    return numbers[0] if numbers else None
+
+def register_participant(draw, full_name, phone, email, ip_address):
+    """Register one participant in its own transaction. Returns (status, lucky_number), status 'ok', 'duplicate' or 'full'."""
+    lucky_number = allocate_lucky_number(draw)
+    if lucky_number is None:
+        db.session.rollback()
+        return 'full', None
+
+    # Trùng email/SĐT do _email_draw_uc/_phone_draw_uc phát hiện lúc insert, không cần SELECT trước
+    participant = Participant(
+        full_name=full_name,
+        phone=phone,
+        email=email,
+        lucky_number=lucky_number,
+        ip_address=ip_address,
+        draw_id=draw.id
+    )
+    db.session.add(participant)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Email hoặc SĐT đã được đăng ký; rollback cũng trả lại số may mắn vừa cấp
+        db.session.rollback()
+        return 'duplicate', None
+    return 'ok', lucky_number
+
+# --- Bộ lọc trùng lặp trong bộ nhớ (tắt bằng DUPLICATE_FILTER=0) ---
+DUPLICATE_FILTER = os.environ.get('DUPLICATE_FILTER', '1') == '1'
+DUPLICATE_FILTER_MAX_DRAWS = 8
+
+class DuplicateFilter:
+    """Per-process LRU of emails and phones already registered for recent draws; the unique constraints stay authoritative."""
+
+    def __init__(self, max_draws):
+        self.max_draws = max_draws
+        self._draws = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entries(self, draw):
+        # Kèm number_key để id đợt quay bị dùng lại không thừa hưởng dữ liệu cũ
+        key = (draw.id, draw.number_key)
+        with self._lock:
+            entries = self._draws.get(key)
+            if entries is not None:
+                self._draws.move_to_end(key)
+                return entries
+        # Nạp từ DB một lần cho mỗi đợt quay, ngoài lock để không chặn các đợt quay khác
+        emails, phones = set(), set()
+        for email, phone in db.session.query(Participant.email, Participant.phone) \
+                .filter(Participant.draw_id == draw.id).yield_per(5000):
+            emails.add(email)
+            phones.add(phone)
+        with self._lock:
+            entries = self._draws.setdefault(key, (emails, phones))
+            while len(self._draws) > self.max_draws:
+                self._draws.popitem(last=False)
+        return entries
+
+    def seen(self, draw, email, phone):
+        emails, phones = self._entries(draw)
+        return email in emails or phone in phones
+
+    def add(self, draw, email, phone):
+        emails, phones = self._entries(draw)
+        emails.add(email)
+        phones.add(phone)
+
+    def forget(self, draw_id):
+        with self._lock:
+            for key in [k for k in self._draws if k[0] == draw_id]:
+                del self._draws[key]
+
+duplicate_filter = DuplicateFilter(DUPLICATE_FILTER_MAX_DRAWS)
+
+# --- Group Commit cho đăng ký (bật bằng REGISTRATION_GROUP_COMMIT=1) ---
+# Ghi một lô khi đủ GROUP_COMMIT_MAX_ROWS dòng hoặc sau GROUP_COMMIT_MAX_WAIT_MS: một lần fsync cho cả lô thay vì mỗi người một lần
+REGISTRATION_GROUP_COMMIT = os.environ.get('REGISTRATION_GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 100))
+GROUP_COMMIT_MAX_WAIT_MS = int(os.environ.get('GROUP_COMMIT_MAX_WAIT_MS', 5))
+# Request chờ writer tối đa chừng này giây trước khi thử rút đăng ký khỏi hàng đợi
+GROUP_COMMIT_TIMEOUT_SECONDS = 30
+
+class RegistrationWriter:
+    """Single writer thread that commits registrations from many requests in one transaction per batch."""
+
+    def __init__(self, max_rows, max_wait_ms):
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self._thread = None
+        self._guard = threading.Lock()
+
+    def submit(self, draw_id, full_name, phone, email, ip_address):
+        with self._guard:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='registration-writer', daemon=True)
+                self._thread.start()
+        future = Future()
+        self.queue.put((future, {'draw_id': draw_id, 'full_name': full_name, 'phone': phone,
+                                 'email': email, 'ip_address': ip_address}))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_rows:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            # Bỏ các đăng ký mà request đã hủy vì chờ quá lâu; từ đây request không hủy được nữa
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with app.app_context():
+                try:
+                    results = self._write_batch([row for _, row in batch])
+                except Exception as e:
+                    db.session.rollback()
+                    logging.warning(f"Group commit of {len(batch)} registrations failed, retrying one by one. Details: {e}")
+                    results = [self._write_one(row) for _, row in batch]
+            for (future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _write_one(self, row):
+        try:
+            draw = db.session.get(Draw, row['draw_id'])
+            return register_participant(draw, row['full_name'], row['phone'], row['email'], row['ip_address'])
+        except Exception as e:
+            db.session.rollback()
+            return e
+
+    def _write_batch(self, rows):
+        results = [None] * len(rows)
+        inserts = []
+        by_draw = defaultdict(list)
+        for i, row in enumerate(rows):
+            by_draw[row['draw_id']].append(i)
+
+        for draw_id, indexes in by_draw.items():
+            # Một query kiểm tra trùng cho cả lô, cộng với trùng lặp ngay trong lô
+            emails = {rows[i]['email'] for i in indexes}
+            phones = {rows[i]['phone'] for i in indexes}
+            taken = db.session.query(Participant.email, Participant.phone).filter(
+                Participant.draw_id == draw_id,
+                or_(Participant.email.in_(emails), Participant.phone.in_(phones))).all()
+            seen_emails = {e for e, _ in taken}
+            seen_phones = {p for _, p in taken}
+            fresh = []
+            for i in indexes:
+                if rows[i]['email'] in seen_emails or rows[i]['phone'] in seen_phones:
+                    results[i] = ('duplicate', None)
+                    continue
+                seen_emails.add(rows[i]['email'])
+                seen_phones.add(rows[i]['phone'])
+                fresh.append(i)
+
+            numbers = allocate_lucky_numbers(db.session.get(Draw, draw_id), len(fresh)) if fresh else []
+            for position, i in enumerate(fresh):
+                if position < len(numbers):
+                    inserts.append({**rows[i], 'lucky_number': numbers[position]})
+                    results[i] = ('ok', numbers[position])
+                else:
+                    results[i] = ('full', None)
+
+        if inserts:
+            db.session.execute(Participant.__table__.insert(), inserts)
+        db.session.commit()
+        return results
+
+registration_writer = RegistrationWriter(GROUP_COMMIT_MAX_ROWS, GROUP_COMMIT_MAX_WAIT_MS)
+
+# --- Đo đạc: thời gian request, query SQL, render template (xem /metrics) ---
+# Log chi tiết các request chậm hơn SLOW_REQUEST_MS, 0 = tắt
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 0))
+SLOW_REQUEST_TOP_QUERIES = 5
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Chạy nhiều process (gunicorn): mỗi process ghi số liệu của mình vào METRICS_DIR tối đa mỗi METRICS_FLUSH_SECONDS
+# và khi bị scrape, /metrics cộng dồn tất cả các file nên số liệu không nhảy theo worker nhận request scrape
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = 5
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text format, optionally summed over several processes."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric['series'].clear()
+
+    def define(self, name, kind, help_text, buckets=None):
+        self._metrics[name] = {'kind': kind, 'help': help_text, 'buckets': buckets, 'series': {}}
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self._metrics[name]['series'][labels] = value
+
+    def inc(self, name, labels, amount=1):
+        series = self._metrics[name]['series']
+        with self._lock:
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        metric = self._metrics[name]
+        with self._lock:
+            counts = metric['series'].setdefault(labels, [0] * (len(metric['buckets']) + 2))
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def write_snapshot(self, directory):
+        """Save this process's series to `directory` as metrics-<pid>.json."""
+        with self._lock:
+            snapshot = {name: [[labels, value] for labels, value in metric['series'].items()]
+                        for name, metric in self._metrics.items()}
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        # Đổi tên nguyên tử: process đang đọc không bao giờ thấy file ghi dở
+        os.replace(tmp_path, path)
+
+    def _combined_series(self, directory):
+        # Cộng các file của mọi process, kể cả worker đã thoát: counter không được giảm khi một worker bị thay
+        combined = {name: {} for name in self._metrics}
+        for filename in os.listdir(directory):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, entries in snapshot.items():
+                if name not in combined:
+                    continue
+                series = combined[name]
+                for labels, value in entries:
+                    labels = tuple(tuple(pair) for pair in labels)
+                    if labels not in series:
+                        series[labels] = value
+                    elif isinstance(value, list):
+                        series[labels] = [a + b for a, b in zip(series[labels], value)]
+                    else:
+                        series[labels] += value
+        return combined
+
+    def render(self, directory=None):
+        if directory:
+            series_by_name = self._combined_series(directory)
+        else:
+            with self._lock:
+                series_by_name = {name: {labels: list(value) if isinstance(value, list) else value
+                                         for labels, value in metric['series'].items()}
+                                  for name, metric in self._metrics.items()}
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for labels, value in sorted(series_by_name[name].items()):
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                suffix = f'{{{label_text}}}' if label_text else ''
+                if metric['kind'] == 'counter':
+                    lines.append(f'{name}{suffix} {value}')
+                    continue
+                prefix = label_text + ',' if label_text else ''
+                for bound, count in zip(metric['buckets'], value):
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {value[-1]}')
+                lines.append(f'{name}_sum{suffix} {value[-2]:.6f}')
+                lines.append(f'{name}_count{suffix} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.define('http_request_duration_seconds', 'histogram', 'Thời gian xử lý request (không gồm phần body stream).', LATENCY_BUCKETS)
+metrics.define('http_requests_total', 'counter', 'Số request theo endpoint, method và status.')
+metrics.define('db_queries_per_request', 'histogram', 'Số câu SQL trong một request.', COUNT_BUCKETS)
+metrics.define('db_query_seconds_per_request', 'histogram', 'Tổng thời gian SQL trong một request.', LATENCY_BUCKETS)
+metrics.define('db_queries_total', 'counter', 'Số câu SQL, context="request" hoặc "background".')
+metrics.define('template_render_seconds', 'histogram', 'Thời gian render template.', LATENCY_BUCKETS)
+metrics.define('log_records_dropped_total', 'counter', 'Số bản ghi log bị bỏ vì hàng đợi log đầy.')
+
+if METRICS_DIR:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+_metrics_flushed_at = 0.0
+_metrics_flush_timer = None
+_metrics_flush_guard = threading.Lock()
+
+def flush_metrics(force=False):
+    """Write this process's metrics to METRICS_DIR, at most every METRICS_FLUSH_SECONDS unless forced."""
+    global _metrics_flushed_at, _metrics_flush_timer
+    if not METRICS_DIR:
+        return
+    with _metrics_flush_guard:
+        wait = METRICS_FLUSH_SECONDS - (time.monotonic() - _metrics_flushed_at)
+        if not force and wait > 0:
+            # Hẹn ghi bù khi hết khoảng chờ để worker không còn request nào vẫn không giữ số liệu cũ
+            if _metrics_flush_timer is None:
+                _metrics_flush_timer = threading.Timer(wait, flush_metrics, kwargs={'force': True})
+                _metrics_flush_timer.daemon = True
+                _metrics_flush_timer.start()
+            return
+        if _metrics_flush_timer is not None:
+            _metrics_flush_timer.cancel()
+            _metrics_flush_timer = None
+        _metrics_flushed_at = time.monotonic()
+    metrics.set('log_records_dropped_total', (), getattr(log_handler, 'dropped', 0))
+    try:
+        metrics.write_snapshot(METRICS_DIR)
+    except OSError as e:
+        logging.warning(f"Could not write metrics to '{METRICS_DIR}'. Details: {e}")
+
+atexit.register(flush_metrics, force=True)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # Lưu trên execution context của chính câu lệnh: câu lệnh lỗi bỏ đi cùng context, không để lại gì trên connection
+    context._query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    if has_request_context() and 'queries' in g:
+        g.queries.append((statement, elapsed))
+        metrics.inc('db_queries_total', (('context', 'request'),))
+    else:
+        metrics.inc('db_queries_total', (('context', 'background'),))
+
+@before_render_template.connect_via(app)
+def _start_template_timer(sender, template, context, **extra):
+    if has_request_context():
+        g.template_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _record_template(sender, template, context, **extra):
+    if has_request_context() and 'template_started' in g:
+        metrics.observe('template_render_seconds', (('template', template.name),),
+                        time.perf_counter() - g.pop('template_started'))
+
+@app.before_request
+def start_request_timer():
+    # Đăng ký trước mọi hook khác để đo cả request bị chặn bởi rate limit
+    g.request_started = time.perf_counter()
+    g.queries = []
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'not_found'
+    sql_time = sum(t for _, t in g.queries)
+    metrics.observe('http_request_duration_seconds', (('endpoint', endpoint),), elapsed)
+    metrics.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                        ('status', str(response.status_code))))
+    metrics.observe('db_queries_per_request', (('endpoint', endpoint),), len(g.queries))
+    metrics.observe('db_query_seconds_per_request', (('endpoint', endpoint),), sql_time)
+    flush_metrics()
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        by_statement = defaultdict(lambda: [0, 0.0])
+        for statement, t in g.queries:
+            entry = by_statement[' '.join(statement.split())[:200]]
+            entry[0] += 1
+            entry[1] += t
+        top = sorted(by_statement.items(), key=lambda item: item[1][1], reverse=True)[:SLOW_REQUEST_TOP_QUERIES]
+        breakdown = '; '.join(f'{count}x {total * 1000:.1f}ms {statement}' for statement, (count, total) in top)
+        logging.warning(f"Slow request {request.method} {request.path} ({endpoint}) took {elapsed * 1000:.0f}ms: "
+                        f"{len(g.queries)} queries in {sql_time * 1000:.0f}ms. Top: {breakdown}",
+                        extra={'latency_ms': round(elapsed * 1000, 1), 'query_count': len(g.queries)})
+    return response
+
+# --- Giới hạn tần suất theo IP (tắt bằng RATE_LIMIT=0) ---
+# endpoint -> (số request liên tiếp tối đa, số token hồi lại mỗi giây, các method bị giới hạn)
+RATE_LIMIT = os.environ.get('RATE_LIMIT', '1') != '0'
+RATE_LIMITS = {
+    'register': (10, 10 / 60, ('POST',)),
+    'get_winner': (20, 1.0, ('GET',)),
+}
+RATE_LIMIT_MAX_KEYS = 10000
+RATE_LIMIT_IDLE_SECONDS = 3600
+# Số lượt đăng ký tối đa từ một IP cho mỗi đợt quay, 0 = không giới hạn
+MAX_REGISTRATIONS_PER_IP = int(os.environ.get('MAX_REGISTRATIONS_PER_IP', 0))
+
+class MemoryBucketStore:
+    """Per-process token buckets, keeping at most `max_keys` keys (LRU)."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+class SqliteBucketStore:
+    """Token buckets shared by the workers of one host through a separate SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate):
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            self._calls += 1
+            if self._calls % 1000 == 0:
+                conn.execute('DELETE FROM bucket WHERE updated < ?', (now - RATE_LIMIT_IDLE_SECONDS,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+class RateLimiter:
+    """Token bucket per (endpoint, IP) pair, configured by RATE_LIMITS."""
+
+    def __init__(self, limits, store):
+        self.limits = limits
+        self.store = store
+
+    def check(self, endpoint, ip):
+        """Return (allowed, retry_after) with retry_after in seconds."""
+        capacity, rate, _ = self.limits[endpoint]
+        allowed, tokens = self.store.take(f'{endpoint}:{ip}', capacity, rate)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+if os.environ.get('RATE_LIMIT_DB'):
+    rate_limiter = RateLimiter(RATE_LIMITS, SqliteBucketStore(os.environ['RATE_LIMIT_DB']))
+else:
+    rate_limiter = RateLimiter(RATE_LIMITS, MemoryBucketStore(RATE_LIMIT_MAX_KEYS))
+
+@app.before_request
+def throttle():
+    # Đăng ký trước các hook khác, request bị chặn không tốn query DB nào
+    if not RATE_LIMIT or request.endpoint not in RATE_LIMITS:
+        return None
+    if request.method not in RATE_LIMITS[request.endpoint][2]:
+        # Mở form đăng ký không tính vào giới hạn, chỉ lượt gửi form
+        return None
+    allowed, retry_after = rate_limiter.check(request.endpoint, request.remote_addr)
+    if not allowed:
+        logging.warning(f"Rate limit hit on '{request.endpoint}' by IP {request.remote_addr}.")
+        return Response('Quá nhiều yêu cầu, vui lòng thử lại sau.', status=429, mimetype='text/plain',
+                        headers={'Retry-After': str(math.ceil(retry_after))})
+    return None
+
+# --- Khởi tạo lười ---
+# Trên serverless không có bước khởi động riêng: request đầu tiên của mỗi instance tạo bảng và nạp cấu hình
+_initialized = False
+_init_lock = threading.Lock()
+
+# Cột mới trên các bảng đã có từ phiên bản đầu; db.create_all() chỉ tạo bảng còn thiếu chứ không thêm cột
+SCHEMA_UPGRADES = (
+    ('draw', 'prize_count', 'INTEGER NOT NULL DEFAULT 1'),
+    ('draw', 'number_key', 'VARCHAR(32)'),
+    ('draw', 'numbers_issued', 'INTEGER NOT NULL DEFAULT 0'),
+    ('draw', 'legacy_numbers', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('draw', 'cleanup_action', 'VARCHAR(10)'),
+    ('draw', 'archived_at', 'TIMESTAMP'),
+)
+
+def upgrade_schema():
+    """Bring a database created by an older version up to the current models; safe to run repeatedly."""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        columns = {}
+        for table, column, ddl in SCHEMA_UPGRADES:
+            if table not in columns:
+                columns[table] = {c['name'] for c in inspector.get_columns(table)}
+            if column in columns[table]:
+                continue
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+            logging.warning(f"Schema upgrade: added column {table}.{column}.")
+            if column == 'legacy_numbers':
+                # Số của các đợt quay đã có người tham gia được cấp ngẫu nhiên, bộ đếm có thể trùng với chúng
+                conn.execute(text('UPDATE draw SET legacy_numbers = TRUE WHERE EXISTS '
+                                  '(SELECT 1 FROM participant WHERE participant.draw_id = draw.id)'))
+        for draw_id, in conn.execute(text('SELECT id FROM draw WHERE number_key IS NULL')).all():
+            conn.execute(text('UPDATE draw SET number_key = :key WHERE id = :id'),
+                         {'key': os.urandom(16).hex(), 'id': draw_id})
+        # Index không duy nhất cũ được thay bằng uq_participant_draw_lucky_number
+        conn.execute(text('DROP INDEX IF EXISTS ix_participant_draw_lucky_number'))
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except IntegrityError as e:
+                logging.error(f"Schema upgrade: could not create index {index.name}, existing rows violate it. Details: {e}")
+
+def initialize():
+    """Create the schema and load settings once per process. Cheap to call again."""
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if not _initialized:
+            with app.app_context():
+                db.create_all()
+                upgrade_schema()
+                settings_cache.load()
+            _initialized = True
+
+@app.before_request
+def initialize_on_first_request():
+    initialize()
+
+# Mỗi lần ghi cài đặt đổi dòng _VERSION; mỗi process so sánh nó tối đa một lần mỗi SETTINGS_CHECK_SECONDS
+SETTINGS_VERSION_KEY = '_VERSION'
+SETTINGS_CHECK_SECONDS = 5
+
+class SettingsCache:
+    """Per-process copy of the Setting table, reloaded when its _VERSION stamp changes."""
+
+    def __init__(self):
+        self.values = {}
+        self.version = None
+        self.loaded = False
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def mail_username(self):
+        return self.values.get('MAIL_USERNAME') or None
+
+    @property
+    def mail_password(self):
+        return self.values.get('MAIL_PASSWORD') or None
+
+    def load(self):
+        with self._lock:
+            values = {s.key: s.value for s in Setting.query.all()}
+            self.version = values.pop(SETTINGS_VERSION_KEY, None)
+            self.values = values
+            self.loaded = True
+            self.checked_at = time.monotonic()
+        update_mail_config()
+
+    def refresh_if_stale(self):
+        if self.loaded and time.monotonic() - self.checked_at < SETTINGS_CHECK_SECONDS:
+            return
+        self.checked_at = time.monotonic()
+        version = db.session.query(Setting.value).filter(Setting.key == SETTINGS_VERSION_KEY).scalar()
+        if not self.loaded or version != self.version:
+            self.load()
+
+    def save(self, **values):
+        """Write settings and bump the version so that other processes reload them."""
+        for key, value in values.items():
+            db.session.merge(Setting(key=key, value=value))
+        db.session.merge(Setting(key=SETTINGS_VERSION_KEY, value=uuid.uuid4().hex))
+        db.session.commit()
+        self.load()
+
+settings_cache = SettingsCache()
+
+@app.before_request
+def refresh_settings():
+    settings_cache.refresh_if_stale()
+
 def update_mail_config():
-    """Load mail settings from DB and update app.config."""
-    with app.app_context():
-        mail_username = Setting.query.get('MAIL_USERNAME')
-        mail_password = Setting.query.get('MAIL_PASSWORD')
-        if mail_username and mail_password:
-            app.config['MAIL_USERNAME'] = mail_username.value
-            app.config['MAIL_PASSWORD'] = mail_password.value
-            app.config['MAIL_DEFAULT_SENDER'] = mail_username.value
-            mail.init_app(app) # Re-initialize mail with new config
+    """Apply the cached mail settings to app.config."""
+    mail_username = settings_cache.mail_username
+    mail_password = settings_cache.mail_password
+    if mail_username and mail_password and (mail_username, mail_password) != \
+            (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']):
+        app.config['MAIL_USERNAME'] = mail_username
+        app.config['MAIL_PASSWORD'] = mail_password
+        app.config['MAIL_DEFAULT_SENDER'] = mail_username
+        if _mail is not None:
+            _mail.init_app(app) # Re-initialize mail with new config
+
+def pick_random_participant(draw_id):
+    """Pick one participant uniformly at random with a COUNT and a single OFFSET row."""
+    query = Participant.query.filter(Participant.draw_id == draw_id)
+    total = query.count()
+    if not total:
+        return None
+    return query.order_by(Participant.id).offset(random.randrange(total)).first()
+
+def sample_participant_ids(draw_id, k):
+    """Pick k distinct participant ids uniformly with reservoir sampling, in random rank order."""
+    reservoir = []
+    rows = db.session.query(Participant.id).filter(Participant.draw_id == draw_id) \
+        .order_by(Participant.id).yield_per(1000)
+    for seen, (participant_id,) in enumerate(rows):
+        if seen < k:
+            reservoir.append(participant_id)
+        else:
+            slot = random.randint(0, seen)
+            if slot < k:
+                reservoir[slot] = participant_id
+    random.shuffle(reservoir)
+    return reservoir
+
+def elect_winners(draw):
+    """Elect the draw's winners once and return them in rank order; empty when it has no participants."""
+    if draw.winner_id is None:
+        if draw.prize_count > 1:
+            winner_ids = sample_participant_ids(draw.id, draw.prize_count)
+        else:
+            candidate = pick_random_participant(draw.id)
+            winner_ids = [candidate.id] if candidate else []
+        if not winner_ids:
+            return []
+
+        winning_number = db.session.query(Participant.lucky_number) \
+            .filter(Participant.id == winner_ids[0]).scalar()
+        # WHERE winner_id IS NULL: không ghi đè kết quả mà worker khác vừa chốt
+        elected = Draw.query.filter(Draw.id == draw.id, Draw.winner_id.is_(None)) \
+            .update({Draw.winner_id: winner_ids[0], Draw.winning_number: winning_number},
+                    synchronize_session=False)
+        if elected:
+            db.session.add_all(Winner(draw_id=draw.id, participant_id=participant_id, rank=rank)
+                               for rank, participant_id in enumerate(winner_ids, start=1))
+        db.session.commit()
+        db.session.refresh(draw)
+        if elected:
+            logging.info(f"Draw '{draw.prize_name}' (ID: {draw.id}) has {len(winner_ids)} winner(s), first: {draw.winner.full_name} (ID: {draw.winner.id}) with number {draw.winning_number}.", extra={'draw_id': draw.id, 'participant_id': draw.winner_id})
+
+    # Các đợt quay cũ chỉ có Draw.winner, chưa có bảng Winner
+    return [w.participant for w in draw.winners] or [draw.winner]
+
+# Kết quả quay số đã chốt, dùng chung cho mọi request trong process
+_winner_cache = {}
+_winner_locks = {}
+_winner_locks_guard = threading.Lock()
+
+def _winner_lock(draw_id):
+    with _winner_locks_guard:
+        return _winner_locks.setdefault(draw_id, threading.Lock())
+
+def resolve_winner(draw_id):
+    """Return the winner payload of a draw, electing it on first call. None if it has no participants."""
+    # Kết quả đã có thì trả thẳng từ cache, không chạm vào DB
+    result = _winner_cache.get(draw_id)
+    if result:
+        return result
+
+    # Chỉ một request cho mỗi đợt quay được phép chọn người thắng, các request khác chờ kết quả
+    with _winner_lock(draw_id):
+        result = _winner_cache.get(draw_id)
+        if result:
+            return result
+
+        draw = get_draw_or_404(draw_id)
+        if draw.winner_id is None and (draw.status == 'Sắp diễn ra' or draw.cleanup_action or draw.archived_at):
+            # Chưa tới giờ quay: không ai được chốt người thắng sớm (và đóng đăng ký) qua /get-winner.
+            # Đang/đã lưu trữ: người tham gia đã chuyển sang kho lưu trữ, không chọn lại
+            return None
+        winners = elect_winners(draw)
+        if not winners:
+            return None
+
+        result = {
+            'winner_name': winners[0].full_name,
+            'winner_phone': winners[0].phone,
+            'winning_number': winners[0].lucky_number,
+            'winners': [{
+                'rank': rank,
+                'winner_name': w.full_name,
+                'winner_phone': w.phone,
+                'winning_number': w.lucky_number
+            } for rank, w in enumerate(winners, start=1)]
+        }
+        _winner_cache[draw_id] = result
+    return result
+
+# --- Đẩy sự kiện vòng quay qua Server-Sent Events ---
+SPIN_SECONDS = 5
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+SSE_QUEUE_SIZE = 8
+# Giới hạn người xem SSE mỗi process; người xem vượt mức nhận 503 và trang quay số tự chuyển sang polling /get-winner.
+# Mặc định cho server thread (mỗi người xem giữ một thread, dùng một nửa số thread); gunicorn.conf.py đặt giá trị
+# theo worker_connections khi chạy worker gevent
+SSE_MAX_CONNECTIONS = int(os.environ.get('SSE_MAX_CONNECTIONS', max(1, int(os.environ.get('GUNICORN_THREADS', 8)) // 2)))
+
+class SpinHub:
+    """Fan out each draw's 'start', 'winner' and 'no_winner' events to every viewer of that draw."""
+
+    def __init__(self, spin_seconds, max_connections):
+        self.spin_seconds = spin_seconds
+        self.max_connections = max_connections
+        self._connections = 0
+        self._subscribers = defaultdict(set)
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, draw_id):
+        """Return a viewer's event queue, or None when this process already has SSE_MAX_CONNECTIONS viewers."""
+        q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self._lock:
+            if self._connections >= self.max_connections:
+                return None
+            self._connections += 1
+            # Người xem đến muộn nhận lại các sự kiện đã phát
+            for entry in self._events.get(draw_id, []):
+                q.put_nowait(entry)
+            self._subscribers[draw_id].add(q)
+        return q
+
+    def unsubscribe(self, draw_id, q):
+        with self._lock:
+            self._connections -= 1
+            self._subscribers[draw_id].discard(q)
+            if not self._subscribers[draw_id]:
+                del self._subscribers[draw_id]
+
+    def publish(self, draw_id, name, data):
+        with self._lock:
+            self._events.setdefault(draw_id, []).append((name, data))
+            for q in list(self._subscribers.get(draw_id, ())):
+                try:
+                    q.put_nowait((name, data))
+                except queue.Full:
+                    # Người xem quá chậm bị bỏ; EventSource kết nối lại sẽ được phát lại từ đầu
+                    self._subscribers[draw_id].discard(q)
+
+    def start_spin(self, draw_id, spin_seconds=None):
+        """Start the shared spin of a draw unless one is already running."""
+        spin_seconds = self.spin_seconds if spin_seconds is None else spin_seconds
+        with self._lock:
+            if draw_id in self._events:
+                return
+            self._events[draw_id] = []
+        self.publish(draw_id, 'start', {'ends_at': time.time() + spin_seconds})
+        timer = threading.Timer(spin_seconds, self._announce, args=(draw_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _announce(self, draw_id):
+        with app.app_context():
+            try:
+                result = resolve_winner(draw_id)
+            except Exception as e:
+                logging.error(f"Could not elect winner for draw ID {draw_id} at the end of the spin. Details: {e}", extra={'draw_id': draw_id})
+                result = None
+        if result:
+            self.publish(draw_id, 'winner', result)
+        else:
+            self.publish(draw_id, 'no_winner', {})
+            # Cho phép lượt xem sau thử lại
+            self.forget(draw_id)
+
+    def forget(self, draw_id):
+        with self._lock:
+            self._events.pop(draw_id, None)
+
+spin_hub = SpinHub(SPIN_SECONDS, SSE_MAX_CONNECTIONS)
+
+def _spin_event_stream(q):
+    yield f'retry: {SSE_RETRY_MS}\n\n'
+    while True:
+        try:
+            name, data = q.get(timeout=SSE_HEARTBEAT_SECONDS)
+        except queue.Empty:
+            yield ': ping\n\n'
+            continue
+        if name == 'start':
+            data = {'remaining_ms': max(0, int((data['ends_at'] - time.time()) * 1000))}
+        yield f'event: {name}\ndata: {json.dumps(data)}\n\n'
+        if name != 'start':
+            return
+
+LOG_LEVELS = ('INFO', 'WARNING', 'ERROR')
+LOG_PAGE_SIZE = 200
+
+def parse_log_line(line):
+    """Return (level, display line) for both text and JSON log lines."""
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            entry = None
+        if isinstance(entry, dict):
+            text = f"{entry.get('ts', '')} {entry.get('level', '')}: {entry.get('message', '')}"
+            fields = ' '.join(f'{k}={entry[k]}' for k in LOG_FIELDS if k in entry)
+            if fields:
+                text += f' [{fields}]'
+            if entry.get('exc_info'):
+                text += '\n' + entry['exc_info']
+            return entry.get('level'), text
+    return next((lv for lv in LOG_LEVELS if f' {lv}: ' in line), None), line
+
+def read_log_backwards(path, end=None, block_size=8192):
+    """Yield (byte offset, line) pairs from the end of `path` (or from byte `end`) backwards, a block at a time."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell() if end is None else min(end, f.tell())
+        buf = b''
+        while True:
+            idx = buf.rfind(b'\n', 0, len(buf) - 1 if buf.endswith(b'\n') else len(buf))
+            if idx == -1 and pos > 0:
+                read = min(block_size, pos)
+                pos -= read
+                f.seek(pos)
+                buf = f.read(read) + buf
+                continue
+            line = buf[idx + 1:].rstrip(b'\r\n')
+            if line:
+                yield pos + idx + 1, line.decode('utf-8', errors='replace')
+            if idx == -1:
+                return
+            buf = buf[:idx + 1]
+
+# --- Mail Outbox ---
+MAIL_BATCH_SIZE = 50
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_BASE_SECONDS = 30
+MAIL_WORKER_POLL_SECONDS = 5
+MAIL_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+def _time_left(deadline):
+    return deadline is None or time.monotonic() < deadline
+
+_background_workers = {}
+_background_workers_guard = threading.Lock()
+
+def _ensure_worker(name, target, wakeup):
+    """Start this process's background thread `name` if it is not running, then wake it up."""
+    if SERVERLESS:
+        # Không có thread nền trên serverless, các việc này chạy qua /cron/tick
+        return
+    with _background_workers_guard:
+        worker = _background_workers.get(name)
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(target=target, name=name, daemon=True)
+            worker.start()
+            _background_workers[name] = worker
+    wakeup.set()
+
+_mail_wakeup = threading.Event()
+
+def enqueue_mail(recipient, subject, body, draw_id=None):
+    """Add an email to the outbox; the caller commits and then calls `start_mail_worker`."""
+    message = OutboxMessage(recipient=recipient, subject=subject, body=body, draw_id=draw_id)
+    db.session.add(message)
+    return message
+
+def _due_outbox_filter(now):
+    # Tin đang chờ đến hạn, hoặc tin bị kẹt ở 'sending' do worker trước đó chết giữa chừng
+    return or_(and_(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now),
+               and_(OutboxMessage.status == 'sending', OutboxMessage.claimed_at < now - MAIL_CLAIM_TIMEOUT))
+
+def _claim_outbox_batch():
+    """Claim up to MAIL_BATCH_SIZE due messages with one UPDATE so that concurrent workers never share a row."""
+    now = datetime.now()
+    token = uuid.uuid4().hex
+    due_ids = db.session.query(OutboxMessage.id).filter(_due_outbox_filter(now)) \
+        .order_by(OutboxMessage.id).limit(MAIL_BATCH_SIZE).scalar_subquery()
+    OutboxMessage.query.filter(OutboxMessage.id.in_(due_ids), _due_outbox_filter(now)) \
+        .update({OutboxMessage.status: 'sending', OutboxMessage.claim_token: token, OutboxMessage.claimed_at: now},
+                synchronize_session=False)
+    db.session.commit()
+    return OutboxMessage.query.filter_by(claim_token=token, status='sending').order_by(OutboxMessage.id).all()
+
+def _record_mail_failure(message, error):
+    message.attempts += 1
+    message.last_error = str(error)[:500]
+    if message.attempts >= MAIL_MAX_ATTEMPTS:
+        message.status = 'failed'
+        logging.error(f"ERROR sending email to {message.recipient} (outbox ID: {message.id}), giving up after {message.attempts} attempts. Details: {error}")
+    else:
+        message.status = 'pending'
+        message.next_attempt_at = datetime.now() + timedelta(seconds=MAIL_RETRY_BASE_SECONDS * 2 ** (message.attempts - 1))
+        logging.warning(f"Sending email to {message.recipient} (outbox ID: {message.id}) failed, retry #{message.attempts} at {message.next_attempt_at:%H:%M:%S}. Details: {error}")
+
+def process_outbox():
+    """Send one batch of due outbox messages over a shared SMTP connection. Returns False when nothing is due."""
+    from flask_mail import Message
+    settings_cache.refresh_if_stale()
+    batch = _claim_outbox_batch()
+    if not batch:
+        return False
+    remaining = list(batch)
+    try:
+        with get_mail().connect() as conn:
+            while remaining:
+                message = remaining[0]
+                conn.send(Message(message.subject, recipients=[message.recipient], body=message.body))
+                message.status = 'sent'
+                message.attempts += 1
+                message.sent_at = datetime.now()
+                message.last_error = None
+                db.session.commit()
+                remaining.pop(0)
+                logging.info(f"Successfully sent email to {message.recipient} (outbox ID: {message.id}).", extra={'draw_id': message.draw_id})
+    except Exception as e:
+        # Chỉ tin gửi lỗi bị tính một lần thử; phần còn lại của lô trả về hàng đợi nguyên vẹn
+        _record_mail_failure(remaining.pop(0), e)
+        for message in remaining:
+            message.status = 'pending'
+        db.session.commit()
+    return True
+
+def _mail_worker_loop():
+    while True:
+        _mail_wakeup.wait(MAIL_WORKER_POLL_SECONDS)
+        _mail_wakeup.clear()
+        try:
+            with app.app_context():
+                while process_outbox():
+                    pass
+        except Exception:
+            logging.exception("Mail outbox worker crashed while processing a batch.")
+
+def start_mail_worker():
+    """Start this process's mail worker thread if needed and wake it up."""
+    _ensure_worker('mail-outbox', _mail_worker_loop, _mail_wakeup)
+
+# --- Bulk Announcements ---
+ANNOUNCE_BATCH_SIZE = 50
+ANNOUNCE_LEASE = timedelta(minutes=5)
+ANNOUNCE_RETRY_SECONDS = 60
+
+_announce_wakeup = threading.Event()
+
+def render_mail_body(template, participant, draw):
+    """Fill the {{full_name}}, {{phone}}, {{email}}, {{prize_name}} and {{lucky_number}} placeholders of an email."""
+    body = template.replace("{{full_name}}", participant.full_name)
+    body = body.replace("{{phone}}", participant.phone)
+    body = body.replace("{{email}}", participant.email)
+    body = body.replace("{{prize_name}}", draw.prize_name)
+    body = body.replace("{{lucky_number}}", participant.lucky_number)
+    return body
+
+def _claim_announcement():
+    now = datetime.now()
+    token = uuid.uuid4().hex
+    due = or_(and_(Announcement.status == 'pending', Announcement.next_attempt_at <= now),
+              and_(Announcement.status == 'running', Announcement.claimed_at < now - ANNOUNCE_LEASE))
+    candidate = db.session.query(Announcement.id).filter(due).order_by(Announcement.id).limit(1).scalar()
+    if candidate is None:
+        return None
+    claimed = Announcement.query.filter(Announcement.id == candidate, due) \
+        .update({Announcement.status: 'running', Announcement.claim_token: token, Announcement.claimed_at: now},
+                synchronize_session=False)
+    db.session.commit()
+    return Announcement.query.filter_by(id=candidate, claim_token=token).first() if claimed else None
+
+def _save_announcement_progress(announcement, **changes):
+    """Save progress and renew the claim; False if another worker has taken the announcement over."""
+    changes['claimed_at'] = datetime.now()
+    saved = Announcement.query.filter(Announcement.id == announcement.id,
+                                      Announcement.claim_token == announcement.claim_token) \
+        .update(changes, synchronize_session=False)
+    db.session.commit()
+    return bool(saved)
+
+def send_announcement(announcement, deadline=None):
+    """Send a claimed announcement from its cursor to the end over one SMTP connection, paced to rate_per_minute."""
+    import smtplib
+    from flask_mail import Message
+    # Lỗi chỉ liên quan tới một người nhận: chuyển email đó sang outbox để thử lại, chiến dịch vẫn chạy tiếp
+    recipient_errors = (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused)
+    settings_cache.refresh_if_stale()
+    draw = announcement.draw
+    interval = 60.0 / announcement.rate_per_minute
+    cursor, sent, failed = announcement.last_participant_id, announcement.sent_count, announcement.failed_count
+    next_send = time.monotonic()
+    try:
+        with get_mail().connect() as conn:
+            while True:
+                batch = db.session.query(Participant.id, Participant.full_name, Participant.phone,
+                                         Participant.email, Participant.lucky_number) \
+                    .filter(Participant.draw_id == draw.id, Participant.id > cursor) \
+                    .order_by(Participant.id).limit(ANNOUNCE_BATCH_SIZE).all()
+                if not batch:
+                    break
+                for participant in batch:
+                    if not _time_left(deadline):
+                        _save_announcement_progress(announcement, status='pending', claim_token=None,
+                                                    last_participant_id=cursor, sent_count=sent, failed_count=failed,
+                                                    next_attempt_at=datetime.now())
+                        return
+                    time.sleep(max(0.0, next_send - time.monotonic()))
+                    next_send = max(next_send + interval, time.monotonic())
+                    # Ghi con trỏ trước khi gửi (kèm gia hạn lease): khởi động lại không gửi trùng cho ai,
+                    # và lease không bao giờ hết hạn giữa chừng dù rate_per_minute thấp
+                    if not _save_announcement_progress(announcement, last_participant_id=participant.id,
+                                                       sent_count=sent, failed_count=failed):
+                        logging.warning(f"Announcement {announcement.id} was taken over by another worker, stopping.")
+                        return
+                    body = render_mail_body(announcement.body, participant, draw)
+                    try:
+                        conn.send(Message(announcement.subject, recipients=[participant.email], body=body))
+                        sent += 1
+                    except recipient_errors as e:
+                        enqueue_mail(participant.email, announcement.subject, body, draw_id=draw.id)
+                        failed += 1
+                        logging.warning(f"Announcement {announcement.id} could not be sent to {participant.email}, moved to outbox. Details: {e}")
+                    cursor = participant.id
+    except Exception as e:
+        db.session.rollback()
+        # Người nhận đang gửi dở chưa nhận được email: lùi con trỏ về người cuối cùng đã gửi xong
+        _save_announcement_progress(announcement, status='pending', claim_token=None, last_participant_id=cursor,
+                                    sent_count=sent, failed_count=failed,
+                                    next_attempt_at=datetime.now() + timedelta(seconds=ANNOUNCE_RETRY_SECONDS))
+        logging.error(f"ERROR sending announcement {announcement.id} for draw '{draw.prize_name}', will resume from recipient after ID {cursor} in {ANNOUNCE_RETRY_SECONDS}s. Details: {e}")
+        return
+
+    _save_announcement_progress(announcement, status='done', claim_token=None, sent_count=sent, failed_count=failed,
+                                finished_at=datetime.now())
+    if failed:
+        start_mail_worker()
+    logging.info(f"Announcement {announcement.id} for draw '{draw.prize_name}' finished: {sent} sent, {failed} moved to outbox.", extra={'draw_id': draw.id})
+
+def _announce_worker_loop():
+    while True:
+        _announce_wakeup.wait(MAIL_WORKER_POLL_SECONDS)
+        _announce_wakeup.clear()
+        try:
+            with app.app_context():
+                while (announcement := _claim_announcement()) is not None:
+                    send_announcement(announcement)
+        except Exception:
+            logging.exception("Announcement worker crashed.")
+
+def start_announcement_worker():
+    """Start this process's announcement worker thread if needed and wake it up."""
+    _ensure_worker('mail-announce', _announce_worker_loop, _announce_wakeup)
+
+# --- Tự động quay số đúng giờ ---
+SCHEDULER_LEASE = timedelta(seconds=60)
+SCHEDULER_MAX_SLEEP_SECONDS = 30
+# Mỗi process một định danh riêng khi giữ lease; tính theo pid hiện tại vì worker được fork từ master đã import app
+_host_id = uuid.uuid4().hex[:8]
+
+def _lease_holder():
+    return f'{_host_id}-{os.getpid()}'
+
+_scheduler_wakeup = threading.Event()
+
+def acquire_lease(name, duration):
+    """Take or renew lease `name` for this process; False if another process holds it."""
+    now = datetime.now()
+    holder = _lease_holder()
+    if db.session.get(Lease, name) is None:
+        try:
+            db.session.add(Lease(name=name, holder=holder, expires_at=now + duration))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+    acquired = Lease.query.filter(Lease.name == name, or_(Lease.holder == holder, Lease.expires_at < now)) \
+        .update({Lease.holder: holder, Lease.expires_at: now + duration}, synchronize_session=False)
+    db.session.commit()
+    return bool(acquired)
+
+def release_lease(name):
+    Lease.query.filter(Lease.name == name, Lease.holder == _lease_holder()).delete(synchronize_session=False)
+    db.session.commit()
+
+def run_due_draws():
+    """Elect draws whose draw_date has passed and warm the winner cache. Returns the next draw_date or None."""
+    now = datetime.now()
+    # Chỉ process giữ lease mới chọn người thắng; các process khác chỉ nạp kết quả đã có vào cache của mình
+    leader = acquire_lease('draw-scheduler', SCHEDULER_LEASE)
+    if leader:
+        due = db.session.query(Draw.id).filter(Draw.winner_id.is_(None), Draw.draw_date <= now,
+                                               Draw.cleanup_action.is_(None), Draw.participants.any()) \
+            .order_by(Draw.draw_date).all()
+        for (draw_id,) in due:
+            if resolve_winner(draw_id):
+                logging.info(f"Scheduler elected the winner of draw ID {draw_id} at its draw time.", extra={'draw_id': draw_id})
+    finished = db.session.query(Draw.id).filter(Draw.winner_id.isnot(None), DRAW_NOT_DELETED).all()
+    for (draw_id,) in finished:
+        if draw_id not in _winner_cache:
+            resolve_winner(draw_id)
+    db.session.commit()
+    return db.session.query(func.min(Draw.draw_date)) \
+        .filter(Draw.winner_id.is_(None), Draw.draw_date > now).scalar()
+
+def _scheduler_loop():
+    while True:
+        timeout = SCHEDULER_MAX_SLEEP_SECONDS
+        try:
+            with app.app_context():
+                next_draw = run_due_draws()
+            if next_draw is not None:
+                timeout = min(timeout, max(0.0, (next_draw - datetime.now()).total_seconds()))
+        except Exception:
+            logging.exception("Draw scheduler crashed while electing due draws.")
+        _scheduler_wakeup.wait(timeout)
+        _scheduler_wakeup.clear()
+
+def start_draw_scheduler():
+    """Start this process's draw scheduler thread if needed and wake it up."""
+    _ensure_worker('draw-scheduler', _scheduler_loop, _scheduler_wakeup)
+
+# --- Xóa và lưu trữ đợt quay trong nền ---
+CLEANUP_CHUNK_SIZE = 1000
+# Nghỉ giữa các khối để request đăng ký/quay số không phải chờ khóa ghi của SQLite quá lâu
+CLEANUP_PAUSE_SECONDS = 0.05
+CLEANUP_LEASE = timedelta(minutes=2)
+
+_cleanup_wakeup = threading.Event()
+
+def _delete_participants_chunk(draw_id, keep_ids=()):
+    """Delete up to CLEANUP_CHUNK_SIZE participants of a draw with one set-based DELETE. Returns the row count."""
+    chunk = db.session.query(Participant.id).filter(Participant.draw_id == draw_id, Participant.id.notin_(keep_ids)) \
+        .order_by(Participant.id).limit(CLEANUP_CHUNK_SIZE).scalar_subquery()
+    deleted = Participant.query.filter(Participant.id.in_(chunk)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def delete_draw_rows(draw_id, deadline=None):
+    """Delete a draw and all of its rows with chunked set-based DELETEs, without loading them into the ORM."""
+    for model in (Winner, OutboxMessage, Announcement, ParticipantArchive):
+        model.query.filter(model.draw_id == draw_id).delete(synchronize_session=False)
+    Draw.query.filter(Draw.id == draw_id).update({Draw.winner_id: None}, synchronize_session=False)
+    db.session.commit()
+    while _delete_participants_chunk(draw_id):
+        if not acquire_lease('draw-cleanup', CLEANUP_LEASE) or not _time_left(deadline):
+            return
+        time.sleep(CLEANUP_PAUSE_SECONDS)
+    Draw.query.filter(Draw.id == draw_id).delete(synchronize_session=False)
+    db.session.commit()
+
+def archive_draw_rows(draw, deadline=None):
+    """Move a finished draw's participants into gzip NDJSON blocks in participant_archive, resumably."""
+    # Người thắng ở lại bảng participant vì Draw.winner và Winner trỏ tới họ
+    keep_ids = [w.participant_id for w in draw.winners] or ([draw.winner_id] if draw.winner_id else [])
+    ranks = {participant_id: rank for rank, participant_id in enumerate(keep_ids, start=1)}
+    cursor = db.session.query(func.max(ParticipantArchive.last_participant_id)) \
+        .filter(ParticipantArchive.draw_id == draw.id).scalar() or 0
+    while True:
+        rows = db.session.query(Participant.id, Participant.full_name, Participant.email, Participant.phone,
+                                Participant.lucky_number, Participant.ip_address) \
+            .filter(Participant.draw_id == draw.id, Participant.id > cursor) \
+            .order_by(Participant.id).limit(CLEANUP_CHUNK_SIZE).all()
+        if not rows:
+            break
+        records = [{**dict(zip(EXPORT_COLUMNS, row)), 'winner_rank': ranks.get(row.id)} for row in rows]
+        payload = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+        compressor = zlib.compressobj(wbits=31)
+        db.session.add(ParticipantArchive(draw_id=draw.id, last_participant_id=rows[-1].id, row_count=len(rows),
+                                          data=compressor.compress(payload) + compressor.flush()))
+        # Ghi khối và xóa dòng gốc trong cùng transaction: bị ngắt thì chạy tiếp từ khối cuối cùng
+        Participant.query.filter(Participant.id.in_([row.id for row in rows]), Participant.id.notin_(keep_ids)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        cursor = rows[-1].id
+        if not acquire_lease('draw-cleanup', CLEANUP_LEASE) or not _time_left(deadline):
+            return
+        time.sleep(CLEANUP_PAUSE_SECONDS)
+    Draw.query.filter(Draw.id == draw.id).update({Draw.cleanup_action: None, Draw.archived_at: datetime.now()},
+                                                 synchronize_session=False)
+    db.session.commit()
+
+def run_draw_cleanup(deadline=None):
+    """Run pending deletes and archives if this process holds the 'draw-cleanup' lease."""
+    if not acquire_lease('draw-cleanup', CLEANUP_LEASE):
+        return
+    while (draw := Draw.query.filter(Draw.cleanup_action.isnot(None)).order_by(Draw.id).first()) is not None:
+        draw_id, prize_name, action = draw.id, draw.prize_name, draw.cleanup_action
+        if action == 'archive':
+            archive_draw_rows(draw, deadline)
+        else:
+            delete_draw_rows(draw_id, deadline)
+        if not _time_left(deadline):
+            # Hết thời gian: nhả lease để lượt chạy sau (có thể ở instance khác) làm tiếp ngay
+            release_lease('draw-cleanup')
+            return
+        logging.info(f"Background {action} of draw '{prize_name}' (ID: {draw_id}) finished.", extra={'draw_id': draw_id})
+
+def _cleanup_worker_loop():
+    while True:
+        _cleanup_wakeup.wait(MAIL_WORKER_POLL_SECONDS)
+        _cleanup_wakeup.clear()
+        try:
+            with app.app_context():
+                run_draw_cleanup()
+        except Exception:
+            logging.exception("Draw cleanup worker crashed.")
+
+def start_cleanup_worker():
+    """Start this process's cleanup worker thread if needed and wake it up."""
+    _ensure_worker('draw-cleanup', _cleanup_worker_loop, _cleanup_wakeup)
 
 def admin_required(f):
     @wraps(f)
@@ -526,12 +2455,14 @@ def admin_required(f):
 # --- Public Routes ---
 @app.route('/')
 def index():
-    draws = Draw.query.order_by(Draw.draw_date.desc()).all()
-    return render_template_string(TPL_INDEX, draws=draws)
+    # Load người thắng cùng lúc với danh sách đợt quay (1 query duy nhất)
+    draws = Draw.query.options(joinedload(Draw.winner)).filter(DRAW_NOT_DELETED) \
+        .order_by(Draw.draw_date.desc()).all()
+    return render_template('index.html', draws=draws)
 
 @app.route('/register/<int:draw_id>', methods=['GET', 'POST'])
 def register(draw_id):
-    draw = Draw.query.get_or_404(draw_id)
+    draw = get_draw_or_404(draw_id)
     if draw.status != 'Sắp diễn ra':
         flash('Đợt quay số này không còn mở để đăng ký.', 'warning')
         return redirect(url_for('index'))
@@ -541,67 +2472,92 @@ def register(draw_id):
         phone = request.form['phone']
         email = request.form['email']
 
-        # Check for duplicates
-        if Participant.query.filter_by(draw_id=draw.id, email=email).first() or \
-           Participant.query.filter_by(draw_id=draw.id, phone=phone).first():
+        if MAX_REGISTRATIONS_PER_IP and Participant.query.filter_by(
+                draw_id=draw.id, ip_address=request.remote_addr).count() >= MAX_REGISTRATIONS_PER_IP:
+            flash('Địa chỉ của bạn đã đăng ký đủ số lượt cho phép trong đợt quay này.', 'warning')
+            logging.warning(f"IP {request.remote_addr} reached {MAX_REGISTRATIONS_PER_IP} registrations for draw ID {draw.id}.", extra={'draw_id': draw.id})
+            return render_template('register.html', draw=draw)
+
+        if DUPLICATE_FILTER and duplicate_filter.seen(draw, email, phone):
+            status, lucky_number = 'duplicate', None
+        elif REGISTRATION_GROUP_COMMIT:
+            # Trả connection về pool trong lúc chờ, để writer không phải tranh connection với các request đang chờ
+            db.session.close()
+            future = registration_writer.submit(draw.id, full_name, phone, email, request.remote_addr)
+            try:
+                status, lucky_number = future.result(timeout=GROUP_COMMIT_TIMEOUT_SECONDS)
+            except FutureTimeoutError:
+                if future.cancel():
+                    logging.warning(f"Registration for draw ID {draw.id} timed out in the group commit queue and was withdrawn.", extra={'draw_id': draw.id})
+                    flash('Hệ thống đang quá tải, đăng ký của bạn chưa được ghi nhận. Vui lòng thử lại sau ít phút.', 'warning')
+                    return render_template('register.html', draw=draw)
+                # Writer đã nhận đăng ký vào lô đang ghi: chờ kết quả thật thay vì báo lỗi khi dòng vẫn có thể được ghi
+                status, lucky_number = future.result()
+        else:
+            status, lucky_number = register_participant(draw, full_name, phone, email, request.remote_addr)
+        if status == 'ok' and DUPLICATE_FILTER:
+            duplicate_filter.add(draw, email, phone)
+
+        if status == 'duplicate':
             flash('Email hoặc Số điện thoại này đã được đăng ký cho đợt quay số này.', 'danger')
-            return render_template_string(TPL_REGISTER, draw=draw)
+            return render_template('register.html', draw=draw)
+        if status == 'full':
+            flash('Đợt quay số này đã hết số may mắn để cấp.', 'warning')
+            logging.warning(f"Draw '{draw.prize_name}' (ID: {draw.id}) has run out of lucky numbers.", extra={'draw_id': draw.id})
+            return render_template('register.html', draw=draw)
 
-        # Generate a unique lucky number
-        while True:
-            lucky_number = str(random.randint(10000, 99999))
-            if not Participant.query.filter_by(draw_id=draw.id, lucky_number=lucky_number).first():
-                break
-        
-        participant = Participant(
-            full_name=full_name,
-            phone=phone,
-            email=email,
-            lucky_number=lucky_number,
-            ip_address=request.remote_addr,
-            draw_id=draw.id
-        )
-        db.session.add(participant)
-        db.session.commit()
-        
-        return render_template_string(TPL_THANK_YOU, lucky_number=lucky_number)
+        return render_template('thank_you.html', lucky_number=lucky_number)
 
-    return render_template_string(TPL_REGISTER, draw=draw)
+    return render_template('register.html', draw=draw)
 
 @app.route('/spin/<int:draw_id>')
 def spin(draw_id):
-    draw = Draw.query.get_or_404(draw_id)
+    draw = get_draw_or_404(draw_id)
     if draw.status == 'Sắp diễn ra':
         flash('Vòng quay chưa bắt đầu.', 'info')
         return redirect(url_for('index'))
-    return render_template_string(TPL_SPIN_PAGE, draw=draw)
+    return render_template('spin.html', draw=draw)
+
+def _draw_not_started(draw_id):
+    # Trả về response lỗi JSON nếu đợt quay không tồn tại hoặc chưa tới giờ quay; kết quả đã cache thì bỏ qua DB
+    if draw_id in _winner_cache:
+        return None
+    draw = Draw.query.filter(Draw.id == draw_id, DRAW_NOT_DELETED).first()
+    if draw is None:
+        return jsonify({'error': 'Draw not found'}), 404
+    if draw.winner_id is None and draw.status == 'Sắp diễn ra':
+        return jsonify({'error': 'Draw has not started'}), 409
+    return None
+
+@app.route('/spin/<int:draw_id>/events')
+def spin_events(draw_id):
+    if SERVERLESS:
+        # Instance bị đóng băng sau mỗi response nên không giữ được stream; trang quay số tự chuyển sang polling
+        return jsonify({'error': 'Live events are not available'}), 503
+    not_ready = _draw_not_started(draw_id)
+    if not_ready:
+        return not_ready
+    # Đợt quay đã có kết quả thì không cần quay lại cho người xem mới
+    spin_hub.start_spin(draw_id, 0 if draw_id in _winner_cache else None)
+    q = spin_hub.subscribe(draw_id)
+    if q is None:
+        return jsonify({'error': 'Too many live viewers'}), 503
+    # Generator không giữ request context, connection DB đã trả về pool trước khi stream bắt đầu
+    response = Response(_spin_event_stream(q), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Server luôn gọi close() khi kết nối kết thúc, kể cả khi generator chưa chạy bước nào
+    response.call_on_close(lambda: spin_hub.unsubscribe(draw_id, q))
+    return response
 
 @app.route('/get-winner/<int:draw_id>')
 def get_winner(draw_id):
-    draw = Draw.query.get_or_404(draw_id)
-
-    if draw.winner:
-        return jsonify({
-            'winner_name': draw.winner.full_name,
-            'winner_phone': draw.winner.phone,
-            'winning_number': draw.winning_number
-        })
-
-    participants = draw.participants
-    if not participants:
+    not_ready = _draw_not_started(draw_id)
+    if not_ready:
+        return not_ready
+    result = resolve_winner(draw_id)
+    if not result:
         return jsonify({'error': 'No participants'}), 404
-
-    winner = random.choice(participants)
-    draw.winner_id = winner.id
-    draw.winning_number = winner.lucky_number
-    db.session.commit()
-    logging.info(f"Draw '{draw.prize_name}' (ID: {draw.id}) has a winner: {winner.full_name} (ID: {winner.id}) with number {winner.lucky_number}.")
-
-    return jsonify({
-        'winner_name': winner.full_name,
-        'winner_phone': winner.phone,
-        'winning_number': winner.lucky_number
-    })
+    return jsonify(result)
 
 # --- Admin Routes ---
 @app.route('/admin', methods=['GET', 'POST'])
@@ -613,6 +2569,8 @@ def login():
         username = request.form['username']
         password = request.form['password']
         if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+            if SESSION_BACKEND == 'db':
+                session.regenerate()
             session['is_admin'] = True
             flash('Đăng nhập thành công!', 'success')
             logging.info("Admin logged in successfully.")
@@ -620,7 +2578,7 @@ def login():
         else:
             flash('Tên đăng nhập hoặc mật khẩu không đúng.', 'danger')
             logging.warning(f"Failed admin login attempt for username: {username}.")
-    return render_template_string(TPL_LOGIN)
+    return render_template('login.html')
 
 @app.route('/admin/logout')
 def logout():
@@ -631,8 +2589,17 @@ def logout():
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    draws = Draw.query.order_by(Draw.draw_date.desc()).all()
-    return render_template_string(TPL_ADMIN_DASHBOARD, draws=draws)
+    draws = Draw.query.filter(DRAW_NOT_DELETED) \
+        .order_by(Draw.draw_date.desc()).all()
+    # Đếm người tham gia của tất cả đợt quay bằng một query GROUP BY
+    participant_counts = dict(db.session.query(Participant.draw_id, func.count(Participant.id))
+                              .group_by(Participant.draw_id).all())
+    # Đợt đã lưu trữ: đếm trong bảng lưu trữ (người thắng nằm ở cả hai bảng)
+    for draw_id, count in db.session.query(ParticipantArchive.draw_id, func.sum(ParticipantArchive.row_count)) \
+            .join(Draw, Draw.id == ParticipantArchive.draw_id).filter(Draw.archived_at.isnot(None)) \
+            .group_by(ParticipantArchive.draw_id):
+        participant_counts[draw_id] = count
+    return render_template('admin/dashboard.html', draws=draws, participant_counts=participant_counts)
 
 @app.route('/admin/create_draw', methods=['POST'])
 @admin_required
@@ -641,76 +2608,256 @@ def create_draw():
     draw_date_str = request.form['draw_date']
     draw_time_str = request.form['draw_time']
     email_content = request.form.get('winner_email_content')
+    try:
+        prize_count = int(request.form.get('prize_count') or 1)
+    except ValueError:
+        prize_count = 0
+    if prize_count < 1:
+        flash('Số giải phải là số nguyên dương.', 'danger')
+        return redirect(url_for('admin_dashboard'))
 
     draw_datetime = datetime.strptime(f"{draw_date_str} {draw_time_str}", '%Y-%m-%d %H:%M')
 
     new_draw = Draw(
         prize_name=prize_name,
         draw_date=draw_datetime,
+        prize_count=prize_count,
         winner_email_content=email_content
     )
     db.session.add(new_draw)
     db.session.commit()
+    # Đợt mới có thể đến hạn sớm hơn lần thức dậy kế tiếp của bộ hẹn giờ
+    start_draw_scheduler()
     flash(f'Đã tạo thành công đợt quay số "{prize_name}".', 'success')
-    logging.info(f"Admin created a new draw: '{prize_name}' (ID: {new_draw.id}).")
+    logging.info(f"Admin created a new draw: '{prize_name}' (ID: {new_draw.id}).", extra={'draw_id': new_draw.id})
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/participants/<int:draw_id>')
 @admin_required
 def view_participants(draw_id):
     draw = Draw.query.get_or_404(draw_id)
-    participants = sorted(draw.participants, key=lambda p: p.id)
-    return render_template_string(TPL_ADMIN_PARTICIPANTS, draw=draw, participants=participants)
+    q = request.args.get('q', '').strip()
+    per_page = request.args.get('per_page', PARTICIPANT_PAGE_SIZES[0], type=int)
+    if per_page not in PARTICIPANT_PAGE_SIZES:
+        per_page = PARTICIPANT_PAGE_SIZES[0]
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+
+    if q:
+        # So khớp chính xác, mỗi nhánh OR đi qua một index riêng: (email, draw_id), (phone, draw_id), (draw_id, lucky_number)
+        query = Participant.query.filter(or_(
+            and_(Participant.draw_id == draw.id, Participant.email == q),
+            and_(Participant.draw_id == draw.id, Participant.phone == q),
+            and_(Participant.draw_id == draw.id, Participant.lucky_number == q)))
+    else:
+        query = Participant.query.filter(Participant.draw_id == draw.id)
+
+    # Keyset pagination theo id: lấy dư 1 dòng để biết còn trang tiếp theo hay không
+    if before is not None:
+        participants = query.filter(Participant.id < before).order_by(Participant.id.desc()).limit(per_page + 1).all()
+        has_prev = len(participants) > per_page
+        participants = participants[:per_page][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(Participant.id > after)
+        participants = query.order_by(Participant.id).limit(per_page + 1).all()
+        has_next = len(participants) > per_page
+        participants = participants[:per_page]
+        has_prev = after is not None
+    next_after = participants[-1].id if has_next and participants else None
+    prev_before = participants[0].id if has_prev and participants else None
+
+    winners = [w.participant for w in draw.winners] or ([draw.winner] if draw.winner else [])
+    announcements = Announcement.query.filter_by(draw_id=draw.id).order_by(Announcement.id.desc()).all()
+    mail_messages = OutboxMessage.query.filter_by(draw_id=draw.id).order_by(OutboxMessage.id.desc()).limit(20).all()
+    return render_template('admin/participants.html', draw=draw, participants=participants,
+                           winners=winners, winner_ids={w.id for w in winners},
+                           announcements=announcements, mail_messages=mail_messages,
+                           q=q, per_page=per_page, next_after=next_after, prev_before=prev_before,
+                           PARTICIPANT_PAGE_SIZES=PARTICIPANT_PAGE_SIZES)
+
+EXPORT_COLUMNS = ('id', 'full_name', 'email', 'phone', 'lucky_number', 'ip_address', 'winner_rank')
+EXPORT_CHUNK_SIZE = 1000
+
+def _archive_blocks(draw):
+    return db.session.query(ParticipantArchive.data).filter(ParticipantArchive.draw_id == draw.id) \
+        .order_by(ParticipantArchive.id).yield_per(10)
+
+def _export_rows(draw):
+    """Stream the draw's participants as dicts: archived blocks first, then the rows still in `participant`."""
+    cursor = 0
+    for (data,) in _archive_blocks(draw):
+        for line in zlib.decompress(data, wbits=31).decode('utf-8').splitlines():
+            record = json.loads(line)
+            cursor = record['id']
+            yield record
+
+    ranks = {w.participant_id: w.rank for w in draw.winners}
+    if not ranks and draw.winner_id is not None:
+        ranks = {draw.winner_id: 1}
+    rows = db.session.query(Participant.id, Participant.full_name, Participant.email, Participant.phone,
+                            Participant.lucky_number, Participant.ip_address) \
+        .filter(Participant.draw_id == draw.id, Participant.id > cursor) \
+        .order_by(Participant.id).yield_per(EXPORT_CHUNK_SIZE)
+    for row in rows:
+        record = dict(zip(EXPORT_COLUMNS, row))
+        record['winner_rank'] = ranks.get(row.id)
+        yield record
+
+def _export_chunks(draw, fmt):
+    """Encode exported rows as CSV or NDJSON, yielding one chunk per EXPORT_CHUNK_SIZE rows."""
+    buffer = io.StringIO()
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+    for count, record in enumerate(_export_rows(draw), start=1):
+        if writer:
+            writer.writerow(record)
+        else:
+            buffer.write(json.dumps(record, ensure_ascii=False) + '\n')
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 = định dạng gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/admin/export/<int:draw_id>')
+@admin_required
+def export_participants(draw_id):
+    draw = Draw.query.get_or_404(draw_id)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        flash('Định dạng xuất không hợp lệ.', 'danger')
+        return redirect(url_for('view_participants', draw_id=draw_id))
+
+    filename = f"draw-{draw.id}-participants.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    chunks = _export_chunks(draw, fmt)
+    if request.args.get('gzip'):
+        filename += '.gz'
+        mimetype = 'application/gzip'
+        if fmt == 'ndjson' and draw.archived_at:
+            # Các khối lưu trữ đã là gzip NDJSON, nối lại là xong
+            chunks = (data for (data,) in _archive_blocks(draw))
+        else:
+            chunks = _gzip_chunks(chunks)
+
+    logging.info(f"Admin exported participants of draw '{draw.prize_name}' (ID: {draw.id}) as {filename}.", extra={'draw_id': draw.id})
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 @app.route('/admin/delete_draw/<int:draw_id>', methods=['GET'])
 @admin_required
 def delete_draw(draw_id):
     draw = Draw.query.get_or_404(draw_id)
     prize_name = draw.prize_name
-    # Cascade delete is configured on the relationship, so this is simpler.
-    db.session.delete(draw)
+    # Chỉ đánh dấu, worker nền xóa theo từng khối để không khóa DB lâu
+    draw.cleanup_action = 'delete'
+    db.session.commit()
+    _winner_cache.pop(draw_id, None)
+    spin_hub.forget(draw_id)
+    duplicate_filter.forget(draw_id)
+    start_cleanup_worker()
+    flash(f'Đợt quay số "{prize_name}" và tất cả người tham gia đang được xóa trong nền.', 'success')
+    logging.info(f"Admin deleted draw '{prize_name}' (ID: {draw_id}).", extra={'draw_id': draw_id})
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/archive_draw/<int:draw_id>', methods=['GET'])
+@admin_required
+def archive_draw(draw_id):
+    draw = Draw.query.get_or_404(draw_id)
+    if draw.status != 'Đã kết thúc' or draw.archived_at or draw.cleanup_action:
+        flash('Chỉ có thể lưu trữ đợt quay đã kết thúc và chưa được lưu trữ.', 'warning')
+        return redirect(url_for('admin_dashboard'))
+    draw.cleanup_action = 'archive'
     db.session.commit()
-    flash(f'Đã xóa đợt quay số "{prize_name}" và tất cả người tham gia.', 'success')
-    logging.info(f"Admin deleted draw '{prize_name}' (ID: {draw_id}).")
+    start_cleanup_worker()
+    flash(f'Đang lưu trữ người tham gia của đợt quay số "{draw.prize_name}" trong nền.', 'success')
+    logging.info(f"Admin archived draw '{draw.prize_name}' (ID: {draw_id}).", extra={'draw_id': draw_id})
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/admin/settings', methods=['GET', 'POST'])
 @admin_required
 def admin_settings():
     if request.method == 'POST':
-        # Update or create MAIL_USERNAME
-        username_setting = Setting.query.get('MAIL_USERNAME')
-        if not username_setting:
-            username_setting = Setting(key='MAIL_USERNAME')
-            db.session.add(username_setting)
-        username_setting.value = request.form['mail_username']
-
-        # Update or create MAIL_PASSWORD
-        password_setting = Setting.query.get('MAIL_PASSWORD')
-        if not password_setting:
-            password_setting = Setting(key='MAIL_PASSWORD')
-            db.session.add(password_setting)
-        password_setting.value = request.form['mail_password']
-        
-        db.session.commit()
-        update_mail_config() # Cập nhật config ngay lập tức
+        # Lưu và cập nhật config ngay lập tức; các worker khác nhận thay đổi qua version stamp
+        settings_cache.save(MAIL_USERNAME=request.form['mail_username'],
+                            MAIL_PASSWORD=request.form['mail_password'])
         flash('Cài đặt email đã được lưu.', 'success')
         logging.info("Admin updated mail settings.")
         return redirect(url_for('admin_settings'))
 
-    settings = {s.key: s.value for s in Setting.query.all()}
-    return render_template_string(TPL_ADMIN_SETTINGS, settings=settings)
+    return render_template('admin/settings.html', settings=settings_cache.values)
 
 @app.route('/admin/logs')
 @admin_required
 def view_logs():
+    level = request.args.get('level', '')
+    q = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+    log_lines = []
+    next_before = None
+    last_offset = None
     try:
-        with open('app.log', 'r', encoding='utf-8') as f:
-            # Đọc ngược file để log mới nhất ở trên
-            log_lines = f.readlines()[::-1]
+        # Đọc ngược file để log mới nhất ở trên, chỉ đọc đủ số dòng của trang hiện tại
+        for offset, line in read_log_backwards(LOG_FILE, before):
+            line_level, text = parse_log_line(line)
+            if level in LOG_LEVELS and line_level != level:
+                continue
+            if q and q.lower() not in text.lower():
+                continue
+            if len(log_lines) == LOG_PAGE_SIZE:
+                next_before = last_offset
+                break
+            log_lines.append(text)
+            last_offset = offset
     except FileNotFoundError:
-        log_lines = []
-    return render_template_string(TPL_LOGS, log_lines=log_lines)
+        pass
+    return render_template('admin/logs.html', log_lines=log_lines, level=level, q=q,
+                           next_before=next_before, LOG_LEVELS=LOG_LEVELS)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Prometheus không đăng nhập được: cho phép thêm header "Authorization: Bearer <METRICS_TOKEN>"
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not session.get('is_admin') and not (METRICS_TOKEN and secrets.compare_digest(token.encode(), METRICS_TOKEN.encode())):
+        return Response('Forbidden', status=403, mimetype='text/plain')
+    metrics.set('log_records_dropped_total', (), getattr(log_handler, 'dropped', 0))
+    flush_metrics(force=True)
+    return Response(metrics.render(METRICS_DIR), mimetype='text/plain; version=0.0.4')
+
+# --- Việc nền khi chạy serverless ---
+# Trên Vercel instance bị đóng băng ngay sau response nên thread nền không chạy; Vercel Cron gọi /cron/tick
+# mỗi phút (xem vercel.json) với header `Authorization: Bearer $CRON_SECRET`
+CRON_SECRET = os.environ.get('CRON_SECRET')
+CRON_BUDGET_SECONDS = float(os.environ.get('CRON_BUDGET_SECONDS', 8))
+
+def run_background_tick(budget):
+    """Run one bounded pass of every background job: due draws, cleanup, outbox and announcements."""
+    deadline = time.monotonic() + budget
+    run_due_draws()
+    run_draw_cleanup(deadline)
+    while _time_left(deadline) and process_outbox():
+        pass
+    while _time_left(deadline) and (announcement := _claim_announcement()) is not None:
+        send_announcement(announcement, deadline)
+
+@app.route('/cron/tick')
+def cron_tick():
+    if not CRON_SECRET or not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {CRON_SECRET}'):
+        return Response('Forbidden', status=403, mimetype='text/plain')
+    run_background_tick(CRON_BUDGET_SECONDS)
+    return jsonify({'status': 'ok'})
 
 @app.route('/admin/send_email/<int:draw_id>')
 @admin_required
@@ -724,34 +2871,81 @@ def send_winner_email(draw_id):
         flash('Vui lòng cấu hình email trong trang Cài đặt trước khi gửi.', 'danger')
         return redirect(url_for('admin_settings'))
 
-    winner = draw.winner
     subject = f"Chúc mừng bạn đã trúng giải: {draw.prize_name}"
-    
-    # Thay thế các biến trong nội dung email
-    body = draw.winner_email_content.replace("{{full_name}}", winner.full_name)
-    body = body.replace("{{phone}}", winner.phone)
-    body = body.replace("{{email}}", winner.email)
-    body = body.replace("{{prize_name}}", draw.prize_name)
-    body = body.replace("{{lucky_number}}", winner.lucky_number)
+    winners = [w.participant for w in draw.winners] or [draw.winner]
+
+    for winner in winners:
+        body = render_mail_body(draw.winner_email_content, winner, draw)
+        enqueue_mail(winner.email, subject, body, draw_id=draw.id)
+
+    # Chỉ ghi vào hàng đợi, worker nền sẽ gửi và tự thử lại nếu lỗi
+    db.session.commit()
+    start_mail_worker()
+    flash(f'Đã xếp {len(winners)} email vào hàng đợi gửi tới: {", ".join(w.email for w in winners)}.', 'success')
+    logging.info(f"Queued winner email(s) for draw '{draw.prize_name}' to {', '.join(w.email for w in winners)}.", extra={'draw_id': draw.id})
+
+    return redirect(url_for('view_participants', draw_id=draw_id))
+
+@app.route('/admin/announce/<int:draw_id>', methods=['POST'])
+@admin_required
+def create_announcement(draw_id):
+    draw = Draw.query.get_or_404(draw_id)
+    if not app.config.get('MAIL_USERNAME'):
+        flash('Vui lòng cấu hình email trong trang Cài đặt trước khi gửi.', 'danger')
+        return redirect(url_for('admin_settings'))
 
-    msg = Message(subject, recipients=[winner.email], body=body)
-    
     try:
-        mail.send(msg)
-        flash(f'Đã gửi email thành công tới {winner.email}.', 'success')
-        logging.info(f"Successfully sent winner email for draw '{draw.prize_name}' to {winner.email}.")
-    except Exception as e:
-        flash(f'Gửi email thất bại: {e}', 'danger')
-        logging.error(f"ERROR sending winner email for draw '{draw.prize_name}' to {winner.email}. Details: {e}")
+        rate_per_minute = int(request.form.get('rate_per_minute') or 1200)
+    except ValueError:
+        rate_per_minute = 0
+    if rate_per_minute < 1:
+        flash('Tốc độ gửi phải là số nguyên dương (email mỗi phút).', 'danger')
+        return redirect(url_for('view_participants', draw_id=draw_id))
 
+    total = Participant.query.filter(Participant.draw_id == draw.id).count()
+    announcement = Announcement(
+        draw_id=draw.id,
+        subject=request.form['subject'],
+        body=request.form['body'],
+        rate_per_minute=rate_per_minute,
+        total_recipients=total
+    )
+    db.session.add(announcement)
+    db.session.commit()
+    start_announcement_worker()
+    flash(f'Đã bắt đầu gửi thông báo tới {total} người tham gia.', 'success')
+    logging.info(f"Admin started announcement {announcement.id} for draw '{draw.prize_name}' (ID: {draw.id}) to {total} participants.", extra={'draw_id': draw.id})
     return redirect(url_for('view_participants', draw_id=draw_id))
 
 
-if __name__ == '__main__':
+def create_app():
+    """Prepare the app once before serving: schema, settings, compiled templates and cached winners."""
+    # Với gunicorn preload_app, hàm này chạy một lần trong master; worker được fork với cache đã nóng
+    initialize()
     with app.app_context():
-        db.create_all()
-        update_mail_config()
-    import os
+        for name in TEMPLATES:
+            app.jinja_env.get_template(name)
+        for (draw_id,) in db.session.query(Draw.id).filter(Draw.winner_id.isnot(None), DRAW_NOT_DELETED):
+            resolve_winner(draw_id)
+        db.session.remove()
+        # Không mang connection của process cha sang các worker sau khi fork
+        db.engine.dispose()
+    return app
+
+def start_background_workers():
+    """Start this process's background threads; call again in every worker after fork."""
+    start_log_listener()
+    # Gửi nốt các email, thông báo và việc dọn dẹp còn dở từ lần chạy trước
+    start_mail_worker()
+    start_announcement_worker()
+    start_cleanup_worker()
+    # Quay bù các đợt đã quá giờ trong lúc server tắt
+    start_draw_scheduler()
+
+if __name__ == '__main__':
+    # Server phát triển; khi chạy thật dùng `gunicorn -c gunicorn.conf.py wsgi:app`
+    create_app()
+    start_background_workers()
     port = int(os.environ.get("PORT", 5000))  # lấy port từ môi trường
     app.run(host="0.0.0.0", port=port, debug=True)  # host=0.0.0.0 để cloud truy cập
 
@@ -0,0 +1,83 @@
+"""Benchmark: cold start of a serverless instance.
+
+Each run starts a fresh interpreter with VERCEL=1 and an empty SQLite
+database, then times `import app`, the first request (which creates the
+schema), and a second, warm request to `/`. Prints the median of RUNS
+runs and the slowest imports reported by `python -X importtime`.
+
+Set COLD_START_BUDGET_MS to exit non-zero when the median import plus
+first request goes over budget, e.g. in CI:
+
+    COLD_START_BUDGET_MS=1500 python benchmarks/cold_start.py
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+RUNS = 7
+SLOWEST_IMPORTS = 10
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+assert client.get('/').status_code == 200
+first = time.perf_counter()
+assert client.get('/').status_code == 200
+second = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': first - imported, 'warm_request': second - first}))
+"""
+
+
+def child_env(workdir):
+    return {**os.environ, 'VERCEL': '1', 'PYTHONPATH': ROOT, 'RATE_LIMIT': '0',
+            'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'cold.db')}
+
+
+def run_once():
+    workdir = tempfile.mkdtemp()
+    out = subprocess.run([sys.executable, '-c', CHILD], cwd=workdir, env=child_env(workdir),
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports():
+    workdir = tempfile.mkdtemp()
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=workdir,
+                         env=child_env(workdir), capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].strip()
+            if '.' not in name:  # chỉ package gốc, tránh đếm trùng
+                rows.append((int(parts[1]), name))
+    return sorted(rows, reverse=True)[:SLOWEST_IMPORTS]
+
+
+def main():
+    run_once()  # nạp sẵn file .pyc vào page cache để các lần đo giống nhau
+    results = [run_once() for _ in range(RUNS)]
+    medians = {key: statistics.median(r[key] for r in results) * 1000 for key in results[0]}
+    for key, value in medians.items():
+        print(f'{key:<16} {value:>8.1f} ms')
+    total = medians['import'] + medians['first_request']
+    print(f"{'cold start':<16} {total:>8.1f} ms")
+    print('\nslowest top-level imports (cumulative):')
+    for micros, name in slowest_imports():
+        print(f'  {name:<24} {micros / 1000:>8.1f} ms')
+
+    budget = os.environ.get('COLD_START_BUDGET_MS')
+    if budget and total > float(budget):
+        print(f'\ncold start {total:.1f} ms is over the budget of {budget} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
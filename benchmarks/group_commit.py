@@ -0,0 +1,74 @@
+"""Benchmark: registration throughput with and without group commit.
+
+Runs THREADS request threads in one process, each POSTing
+REGISTRATIONS_PER_THREAD sign-ups to /register/<id>, once with the default
+one-commit-per-request path and once with REGISTRATION_GROUP_COMMIT=1.
+Reports registrations/s and how many COMMITs reached the database.
+
+    python benchmarks/group_commit.py
+"""
+import os
+import sys
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+THREADS = 32
+REGISTRATIONS_PER_THREAD = 40
+
+
+def run_child():
+    os.chdir(tempfile.mkdtemp())
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(os.getcwd(), 'bench.db')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from sqlalchemy import event
+    import app as lottery
+
+    with lottery.app.app_context():
+        lottery.db.create_all()
+        draw = lottery.Draw(prize_name='bench', draw_date=datetime.now() + timedelta(days=1))
+        lottery.db.session.add(draw)
+        lottery.db.session.commit()
+        draw_id = draw.id
+        commits = [0]
+        event.listen(lottery.db.engine, 'commit', lambda conn: commits.__setitem__(0, commits[0] + 1))
+
+    failures = []
+
+    def sign_up(thread):
+        client = lottery.app.test_client()
+        for i in range(REGISTRATIONS_PER_THREAD):
+            response = client.post(f'/register/{draw_id}', data={
+                'full_name': f'Thread {thread} #{i}', 'phone': f'{thread:02d}{i:06d}',
+                'email': f't{thread}-{i}@example.com'})
+            if response.status_code != 200:
+                failures.append(response.status_code)
+
+    threads = [threading.Thread(target=sign_up, args=(t,)) for t in range(THREADS)]
+    commits[0] = 0
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = THREADS * REGISTRATIONS_PER_THREAD
+    print(f'{total / elapsed:>10.1f} {commits[0]:>9} {total / max(commits[0], 1):>12.1f} {len(failures):>8}')
+
+
+def main():
+    if '--child' in sys.argv:
+        run_child()
+        return
+    print(f"{'mode':<14} {'reg/s':>10} {'commits':>9} {'rows/commit':>12} {'failed':>8}")
+    for label, enabled in (('per-request', '0'), ('group commit', '1')):
+        sys.stdout.write(f'{label:<14} ')
+        sys.stdout.flush()
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child'],
+                       env={**os.environ, 'REGISTRATION_GROUP_COMMIT': enabled, 'RATE_LIMIT': '0'}, check=True)
+
+
+if __name__ == '__main__':
+    main()
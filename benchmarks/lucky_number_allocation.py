@@ -0,0 +1,74 @@
+"""Benchmark: cost of handing out a lucky number as a draw fills up.
+
+Compares `allocate_lucky_number` against the old random-retry loop at
+several fill levels of the 90,000-number space.
+
+    python benchmarks/lucky_number_allocation.py
+"""
+import os
+import sys
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as lottery  # noqa: E402
+
+FILL_LEVELS = (0.0, 0.25, 0.5, 0.75, 0.9, 0.99)
+SAMPLES = 200
+# The retry loop scans the draw once per attempt, keep it short near full.
+LEGACY_SAMPLES = 20
+
+
+def legacy_allocate(draw):
+    while True:
+        lucky_number = str(random.randint(10000, 99999))
+        if not lottery.Participant.query.filter_by(draw_id=draw.id, lucky_number=lucky_number).first():
+            return lucky_number
+
+
+def prefill(draw, fill):
+    count = int(lottery.LUCKY_NUMBER_SPACE * fill)
+    key = bytes.fromhex(draw.number_key)
+    rows = [{
+        'full_name': f'User {i}', 'phone': f'p{i}', 'email': f'u{i}@example.com',
+        'lucky_number': str(lottery.LUCKY_NUMBER_MIN + lottery._permute_lucky_index(key, i)),
+        'draw_id': draw.id,
+    } for i in range(count)]
+    if rows:
+        lottery.db.session.execute(lottery.Participant.__table__.insert(), rows)
+    draw.numbers_issued = count
+    lottery.db.session.commit()
+
+
+def run(allocate, fill, samples):
+    draw = lottery.Draw(prize_name=f'bench {fill}', draw_date=datetime.now() + timedelta(days=1))
+    lottery.db.session.add(draw)
+    lottery.db.session.commit()
+    prefill(draw, fill)
+    samples = min(samples, lottery.LUCKY_NUMBER_SPACE - draw.numbers_issued)
+    start = time.perf_counter()
+    for i in range(samples):
+        number = allocate(draw)
+        lottery.db.session.add(lottery.Participant(
+            full_name='bench', phone=f'b{i}', email=f'b{i}@example.com',
+            lucky_number=number, draw_id=draw.id))
+        lottery.db.session.commit()
+    return (time.perf_counter() - start) / samples * 1e6
+
+
+def main():
+    with lottery.app.app_context():
+        lottery.db.create_all()
+        print(f"{'fill':>6} {'allocator (us)':>16} {'retry loop (us)':>16}")
+        for fill in FILL_LEVELS:
+            print(f'{fill:>6.0%} {run(lottery.allocate_lucky_number, fill, SAMPLES):>16.1f} '
+                  f'{run(legacy_allocate, fill, LEGACY_SAMPLES):>16.1f}')
+
+
+if __name__ == '__main__':
+    main()
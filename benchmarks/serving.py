@@ -0,0 +1,116 @@
+"""Benchmark: requests/s of the debug dev server versus gunicorn with gunicorn.conf.py.
+
+Seeds a temporary SQLite database with one finished draw, starts each
+server on a free port, and has CLIENTS keep-alive client threads request
+`/` and `/get-winner/<id>` for DURATION seconds.
+
+    python benchmarks/serving.py
+"""
+import os
+import sys
+import http.client
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLIENTS = 16
+DURATION = 10
+PARTICIPANTS = 2000
+
+
+def seed(workdir):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as lottery
+    with lottery.app.app_context():
+        lottery.db.create_all()
+        draw = lottery.Draw(prize_name='bench', draw_date=datetime.now() - timedelta(minutes=1))
+        lottery.db.session.add(draw)
+        lottery.db.session.commit()
+        lottery.db.session.add_all(lottery.Participant(
+            full_name=f'User {i}', phone=f'09{i:08d}', email=f'u{i}@example.com',
+            lucky_number=lottery.allocate_lucky_number(draw), draw_id=draw.id) for i in range(PARTICIPANTS))
+        lottery.db.session.commit()
+        lottery.elect_winners(draw)
+        return draw.id
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def load(port, paths):
+    counts, errors = [0] * CLIENTS, [0] * CLIENTS
+    stop = time.monotonic() + DURATION
+
+    def client(n):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        while time.monotonic() < stop:
+            try:
+                conn.request('GET', paths[counts[n] % len(paths)])
+                response = conn.getresponse()
+                response.read()
+                if response.status == 200:
+                    counts[n] += 1
+                else:
+                    errors[n] += 1
+                if response.will_close:
+                    conn.close()
+            except OSError:
+                errors[n] += 1
+                conn.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(CLIENTS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / DURATION, sum(errors)
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    draw_id = seed(workdir)
+    paths = ['/', f'/get-winner/{draw_id}']
+    servers = (
+        ('python app.py', [sys.executable, os.path.join(ROOT, 'app.py')]),
+        ('gunicorn', [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), 'wsgi:app']),
+    )
+    print(f"{'server':<16} {'req/s':>10} {'errors':>8}")
+    for label, command in servers:
+        port = free_port()
+        env = {**os.environ, 'PORT': str(port), 'RATE_LIMIT': '0', 'PYTHONPATH': ROOT}
+        process = subprocess.Popen(command, cwd=workdir, env=env, start_new_session=True,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(port)
+            rate, errors = load(port, paths)
+            print(f'{label:<16} {rate:>10.1f} {errors:>8}')
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
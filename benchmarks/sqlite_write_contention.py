@@ -0,0 +1,79 @@
+"""Benchmark: parallel registrations against SQLite with and without tuning.
+
+Forks WORKERS processes that each POST REGISTRATIONS_PER_WORKER sign-ups to
+/register/<id> through the Flask test client, once with SQLITE_TUNING=0
+(default rollback journal, no busy timeout) and once with the WAL/PRAGMA
+setup, and reports throughput and error rate.
+
+    python benchmarks/sqlite_write_contention.py
+"""
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import multiprocessing
+from datetime import datetime, timedelta
+
+WORKERS = 8
+REGISTRATIONS_PER_WORKER = 150
+
+
+def register_many(worker, draw_id, results):
+    import app as lottery
+    with lottery.app.app_context():
+        lottery.db.engine.dispose(close=False)  # never share pooled connections across fork
+    client = lottery.app.test_client()
+    ok = errors = 0
+    for i in range(REGISTRATIONS_PER_WORKER):
+        response = client.post(f'/register/{draw_id}', data={
+            'full_name': f'Worker {worker} #{i}', 'phone': f'{worker:02d}{i:06d}', 'email': f'w{worker}-{i}@example.com'})
+        if response.status_code == 200:
+            ok += 1
+        else:
+            errors += 1
+    results.put((ok, errors))
+
+
+def run_child():
+    os.chdir(tempfile.mkdtemp())
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(os.getcwd(), 'bench.db')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import app as lottery
+    with lottery.app.app_context():
+        lottery.db.create_all()
+        draw = lottery.Draw(prize_name='bench', draw_date=datetime.now() + timedelta(days=1))
+        lottery.db.session.add(draw)
+        lottery.db.session.commit()
+        draw_id = draw.id
+        lottery.db.engine.dispose()
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=register_many, args=(w, draw_id, results)) for w in range(WORKERS)]
+    start = time.perf_counter()
+    for p in workers:
+        p.start()
+    totals = [results.get() for _ in workers]
+    for p in workers:
+        p.join()
+    elapsed = time.perf_counter() - start
+    ok = sum(t[0] for t in totals)
+    errors = sum(t[1] for t in totals)
+    print(f'{ok / elapsed:>10.1f} {errors / (ok + errors):>10.1%} {ok:>8} {errors:>8}')
+
+
+def main():
+    if '--child' in sys.argv:
+        run_child()
+        return
+    print(f"{'mode':<10} {'reg/s':>10} {'errors':>10} {'ok':>8} {'failed':>8}")
+    for label, tuning in (('default', '0'), ('tuned', '1')):
+        sys.stdout.write(f'{label:<10} ')
+        sys.stdout.flush()
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child'],
+                       env={**os.environ, 'SQLITE_TUNING': tuning, 'RATE_LIMIT': '0'}, check=True)
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('fork')
+    main()
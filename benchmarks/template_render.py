@@ -0,0 +1,68 @@
+"""Benchmark: per-request render time of `index` and `view_participants`.
+
+"before" compiles the page and its base template from source on every
+render, which is what `render_template_string` used to do; "after" uses the
+registered templates that Jinja compiles once per process.
+
+    python benchmarks/template_render.py
+"""
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import render_template  # noqa: E402
+
+import app as lottery  # noqa: E402
+
+ROUNDS = 200
+
+
+def seed():
+    draws = [lottery.Draw(prize_name=f'VPS #{i}', draw_date=datetime.now() + timedelta(days=i - 6))
+             for i in range(12)]
+    lottery.db.session.add_all(draws)
+    lottery.db.session.commit()
+    lottery.db.session.add_all(lottery.Participant(
+        full_name=f'User {i}', phone=f'09{i:08d}', email=f'u{i}@example.com',
+        lucky_number=lottery.allocate_lucky_number(draws[0]), draw_id=draws[0].id) for i in range(50))
+    lottery.db.session.commit()
+    return draws[0]
+
+
+def page_contexts(draw):
+    participants = lottery.Participant.query.filter_by(draw_id=draw.id).order_by(lottery.Participant.id).all()
+    return {
+        'index.html': {'draws': lottery.Draw.query.all()},
+        'admin/participants.html': {
+            'draw': draw, 'participants': participants, 'winners': [], 'winner_ids': set(),
+            'q': '', 'per_page': 50, 'next_after': None, 'prev_before': None,
+            'PARTICIPANT_PAGE_SIZES': lottery.PARTICIPANT_PAGE_SIZES,
+        },
+    }
+
+
+def main():
+    app = lottery.app
+    with app.app_context():
+        lottery.db.create_all()
+        draw = seed()
+        with app.test_request_context('/'):
+            uncached = app.jinja_env.overlay(cache_size=0)
+            print(f"{'template':<26} {'before (us)':>12} {'after (us)':>12}")
+            for name, context in page_contexts(draw).items():
+                full_context = dict(context)
+                app.update_template_context(full_context)
+                before = timeit.timeit(lambda: uncached.get_template(name).render(full_context), number=ROUNDS)
+                render_template(name, **context)  # warm the compiled template cache
+                after = timeit.timeit(lambda: render_template(name, **context), number=ROUNDS)
+                print(f'{name:<26} {before / ROUNDS * 1e6:>12.1f} {after / ROUNDS * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Cấu hình gunicorn cho production (xem Dockerfile)
+import os
+import tempfile
+import multiprocessing
+
+# Mọi worker cùng ghi app.log: việc ghi và xoay file được khóa chung qua app.log.lock để các lần rollover
+# không giẫm lên nhau, app.log vẫn giới hạn 5MB x 5 file mà không cần logrotate trong image
+os.environ.setdefault('LOG_ROTATION', 'shared')
+# /metrics cộng số liệu của mọi worker qua các file trong thư mục này
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'lottery-metrics'))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Nạp app một lần trong master: tạo bảng và làm nóng cache trước khi fork
+preload_app = True
+
+# SSE của trang quay số giữ kết nối suốt buổi quay. Worker gevent phục vụ mỗi kết nối bằng một greenlet nên một
+# worker giữ được hàng trăm người xem; mặc định dành một nửa worker_connections cho SSE (SSE_MAX_CONNECTIONS),
+# người xem vượt mức nhận 503 và trang quay số tự chuyển sang polling /get-winner.
+# GUNICORN_WORKER_CLASS=gthread: mỗi người xem giữ một thread, nên chỉ dành threads / 2 cho SSE.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+    # Vá thread/queue/socket/time trước khi preload_app nạp app: khóa, Timer và hàng đợi của SpinHub
+    # cùng các worker nền đều chạy bằng greenlet
+    from gevent import monkey
+    monkey.patch_all()
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+os.environ.setdefault('SSE_MAX_CONNECTIONS', str(max(1, (worker_connections if worker_class == 'gevent' else threads) // 2)))
+keepalive = 5
+
+# Khi nhận SIGTERM, worker ngừng nhận request mới và có tối đa graceful_timeout giây để trả nốt
+timeout = 60
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # Số liệu /metrics của lần chạy trước không cộng dồn vào lần này
+    metrics_dir = os.environ['METRICS_DIR']
+    for name in os.listdir(metrics_dir) if os.path.isdir(metrics_dir) else ():
+        if name.startswith('metrics-'):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def post_fork(server, worker):
+    # Thread không sống sót qua fork, khởi động lại các worker nền trong từng process
+    from app import metrics, start_background_workers
+    # Query lúc làm nóng cache thuộc về master, không tính lại trong từng worker
+    metrics.clear()
+    start_background_workers()
+
@@ -0,0 +1,156 @@
+import email
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+# app.py đọc cấu hình từ biến môi trường lúc import: dùng database tạm, log ra stderr, tắt giới hạn tần suất
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'test.db')
+os.environ['LOG_FILE'] = ''
+os.environ['LOG_ASYNC'] = '0'
+os.environ['RATE_LIMIT'] = '0'
+os.environ['SECRET_KEY'] = 'test'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as lottery  # noqa: E402
+
+lottery.app.config['TESTING'] = True
+
+
+@pytest.fixture
+def app_ctx():
+    """An app context over an empty database."""
+    lottery.initialize()
+    with lottery.app.app_context():
+        for table in lottery.db.metadata.tables.values():
+            lottery.db.session.execute(table.delete())
+        lottery.db.session.commit()
+        lottery._winner_cache.clear()
+        yield lottery.app
+        lottery.db.session.remove()
+
+
+@pytest.fixture
+def client(app_ctx):
+    return app_ctx.test_client()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def read_data(self):
+        lines = []
+        while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        return b''.join(lines)
+
+    def handle(self):
+        server = self.server
+        messages = []
+        with server.lock:
+            server.connections.append(messages)
+        self.reply('220 localhost fake SMTP')
+        sender, recipients = None, []
+        while line := self.rfile.readline():
+            command = line.decode().strip()
+            verb, _, arg = command.partition(' ')
+            verb = verb.upper()
+            address = arg.partition(':')[2].strip().strip('<>')
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = address, []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                if address in server.reject_recipients:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                with server.lock:
+                    server.received += 1
+                    number = server.received
+                if number == server.drop_on_message:
+                    # Cắt kết nối giữa chừng, không trả lời
+                    return
+                if server.data_reply:
+                    self.reply(server.data_reply)
+                    continue
+                messages.append({'from': sender, 'to': recipients, 'message': email.message_from_bytes(data)})
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """A minimal SMTP server on localhost that records every connection and the messages it carried."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        # Mỗi kết nối một list các thư đã nhận qua nó
+        self.connections = []
+        self.received = 0
+        # Lỗi giả lập: người nhận bị từ chối, reply thay cho '250' sau DATA, số thứ tự thư mà server cắt kết nối
+        self.reject_recipients = set()
+        self.data_reply = None
+        self.drop_on_message = None
+
+    @property
+    def messages(self):
+        return [message for connection in self.connections for message in connection]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.fixture
+def smtp_server(app_ctx):
+    """Point Flask-Mail at a FakeSMTPServer on localhost with sending enabled."""
+    server = FakeSMTPServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    overrides = {'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': server.server_address[1], 'MAIL_USE_TLS': False,
+                 'MAIL_USE_SSL': False, 'MAIL_SUPPRESS_SEND': False, 'MAIL_DEFAULT_SENDER': 'noreply@example.com'}
+    saved = {key: app_ctx.config[key] for key in overrides if key in app_ctx.config}
+    app_ctx.config.update(overrides)
+    lottery.get_mail().init_app(app_ctx)
+    yield server
+    server.stop()
+    for key in overrides:
+        if key in saved:
+            app_ctx.config[key] = saved[key]
+        else:
+            del app_ctx.config[key]
+    lottery.get_mail().init_app(app_ctx)
+
+
+def make_draw(participants=0, started=False, **fields):
+    draw = lottery.Draw(prize_name='VPS', draw_date=datetime.now() + timedelta(days=-1 if started else 1), **fields)
+    lottery.db.session.add(draw)
+    lottery.db.session.commit()
+    for i in range(participants):
+        lottery.db.session.add(lottery.Participant(
+            full_name=f'User {i}', phone=f'09{i:08d}', email=f'user{i}@example.com',
+            lucky_number=lottery.allocate_lucky_number(draw), draw_id=draw.id))
+    lottery.db.session.commit()
+    return draw
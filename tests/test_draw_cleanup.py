@@ -0,0 +1,35 @@
+from conftest import lottery, make_draw
+
+
+def test_archived_draw_keeps_its_public_result(client):
+    draw = make_draw(30, started=True)
+    before = client.get(f'/get-winner/{draw.id}').json
+
+    lottery.archive_draw_rows(draw)
+    lottery._winner_cache.clear()
+
+    lottery.db.session.refresh(draw)
+    assert draw.archived_at is not None
+    assert lottery.Participant.query.filter_by(draw_id=draw.id).count() == 1
+    assert client.get(f'/get-winner/{draw.id}').json == before
+    assert client.get(f'/spin/{draw.id}').status_code == 200
+
+
+def test_archiving_draw_is_never_elected(client):
+    draw = make_draw(5, started=True, cleanup_action='archive')
+
+    assert lottery.resolve_winner(draw.id) is None
+    lottery.db.session.refresh(draw)
+    assert draw.winner_id is None
+
+
+def test_draw_pending_delete_is_gone(client):
+    draw = make_draw(5, started=True, cleanup_action='delete')
+
+    response = client.get(f'/get-winner/{draw.id}')
+    assert response.status_code == 404
+    assert response.json == {'error': 'Draw not found'}
+    assert client.get(f'/spin/{draw.id}').status_code == 404
+    assert client.post(f'/register/{draw.id}', data={'full_name': 'A', 'phone': '1', 'email': 'a@example.com'}).status_code == 404
+    lottery.db.session.refresh(draw)
+    assert draw.winner_id is None
@@ -0,0 +1,40 @@
+import logging
+import multiprocessing
+import os
+
+from conftest import lottery
+
+PROCESSES = 4
+LINES_PER_PROCESS = 3000
+MAX_BYTES = 4096
+
+
+def _write_lines(path, worker):
+    handler = lottery.SharedRotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=1000,
+                                                encoding='utf-8', delay=True)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for i in range(LINES_PER_PROCESS):
+        handler.emit(logging.makeLogRecord({'msg': f'worker={worker} line={i}'}))
+    handler.close()
+
+
+def test_processes_share_rotation_without_losing_lines(tmp_path):
+    path = str(tmp_path / 'app.log')
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_write_lines, args=(path, n)) for n in range(PROCESSES)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(30)
+        assert proc.exitcode == 0
+
+    files = [f for f in os.listdir(tmp_path) if f.startswith('app.log') and not f.endswith('.lock')]
+    assert len(files) > 1
+    lines = []
+    for name in files:
+        assert os.path.getsize(tmp_path / name) <= MAX_BYTES
+        with open(tmp_path / name, encoding='utf-8') as f:
+            lines.extend(f.read().splitlines())
+    expected = {f'worker={w} line={i}' for w in range(PROCESSES) for i in range(LINES_PER_PROCESS)}
+    assert len(lines) == len(expected)
+    assert set(lines) == expected
@@ -0,0 +1,44 @@
+import multiprocessing
+
+from conftest import lottery
+
+
+def make_registry():
+    registry = lottery.MetricsRegistry()
+    registry.define('requests_total', 'counter', 'Requests.')
+    registry.define('latency_seconds', 'histogram', 'Latency.', (0.1, 1.0))
+    return registry
+
+
+def _record_in_child(directory):
+    registry = make_registry()
+    registry.inc('requests_total', (('endpoint', 'index'),), 3)
+    registry.inc('requests_total', (('endpoint', 'register'),))
+    registry.observe('latency_seconds', (('endpoint', 'index'),), 0.5)
+    registry.write_snapshot(directory)
+
+
+def test_render_sums_snapshots_of_all_processes(tmp_path):
+    process = multiprocessing.get_context('fork').Process(target=_record_in_child, args=(str(tmp_path),))
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+
+    registry = make_registry()
+    registry.inc('requests_total', (('endpoint', 'index'),), 2)
+    registry.observe('latency_seconds', (('endpoint', 'index'),), 0.05)
+    registry.write_snapshot(str(tmp_path))
+
+    lines = registry.render(str(tmp_path)).splitlines()
+    assert 'requests_total{endpoint="index"} 5' in lines
+    assert 'requests_total{endpoint="register"} 1' in lines
+    assert 'latency_seconds_bucket{endpoint="index",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{endpoint="index",le="1.0"} 2' in lines
+    assert 'latency_seconds_count{endpoint="index"} 2' in lines
+    assert 'latency_seconds_sum{endpoint="index"} 0.550000' in lines
+
+
+def test_render_without_directory_uses_this_process_only(tmp_path):
+    registry = make_registry()
+    registry.inc('requests_total', (('endpoint', 'index'),))
+    assert 'requests_total{endpoint="index"} 1' in registry.render().splitlines()
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+from conftest import lottery
+
+
+def enqueue(*recipients):
+    messages = [lottery.enqueue_mail(recipient, 'Kết quả', f'Xin chào {recipient}') for recipient in recipients]
+    lottery.db.session.commit()
+    return [message.id for message in messages]
+
+
+def get_message(message_id):
+    return lottery.db.session.get(lottery.OutboxMessage, message_id)
+
+
+def make_due(message_id):
+    message = get_message(message_id)
+    message.next_attempt_at = datetime.now() - timedelta(seconds=1)
+    lottery.db.session.commit()
+    return message
+
+
+def test_outbox_delivers_and_marks_sent(smtp_server):
+    ids = enqueue('a@example.com', 'b@example.com')
+    assert lottery.process_outbox() is True
+    assert lottery.process_outbox() is False
+
+    assert [m['to'] for m in smtp_server.messages] == [['a@example.com'], ['b@example.com']]
+    delivered = smtp_server.messages[0]
+    assert delivered['from'] == 'noreply@example.com'
+    assert delivered['message']['To'] == 'a@example.com'
+    assert 'Xin chào a@example.com' in delivered['message'].get_payload(decode=True).decode('utf-8')
+    for message_id in ids:
+        message = get_message(message_id)
+        assert message.status == 'sent'
+        assert message.attempts == 1
+        assert message.sent_at is not None
+        assert message.last_error is None
+
+
+def test_outbox_sends_a_batch_over_one_connection(smtp_server, monkeypatch):
+    monkeypatch.setattr(lottery, 'MAIL_BATCH_SIZE', 3)
+    enqueue(*(f'user{i}@example.com' for i in range(5)))
+    while lottery.process_outbox():
+        pass
+
+    assert [len(connection) for connection in smtp_server.connections] == [3, 2]
+    assert [m['to'] for m in smtp_server.messages] == [[f'user{i}@example.com'] for i in range(5)]
+
+
+def test_outbox_retries_after_disconnect_with_backoff(smtp_server):
+    smtp_server.drop_on_message = 2
+    sent_id, failed_id, queued_id = enqueue('a@example.com', 'b@example.com', 'c@example.com')
+    before = datetime.now()
+    lottery.process_outbox()
+
+    assert get_message(sent_id).status == 'sent'
+    failed = get_message(failed_id)
+    assert (failed.status, failed.attempts) == ('pending', 1)
+    assert failed.last_error
+    assert failed.next_attempt_at >= before + timedelta(seconds=lottery.MAIL_RETRY_BASE_SECONDS)
+    # Tin phía sau không bị tính là một lần thử hỏng
+    queued = get_message(queued_id)
+    assert (queued.status, queued.attempts) == ('pending', 0)
+
+    # Chỉ tin chưa tới hạn thử lại là còn chờ, tin còn lại đi qua kết nối mới
+    lottery.process_outbox()
+    assert [m['to'] for m in smtp_server.messages] == [['a@example.com'], ['c@example.com']]
+
+    make_due(failed_id)
+    lottery.process_outbox()
+    assert [m['to'] for m in smtp_server.messages] == [['a@example.com'], ['c@example.com'], ['b@example.com']]
+    assert (get_message(failed_id).status, get_message(failed_id).attempts) == ('sent', 2)
+    assert len(smtp_server.connections) == 3
+
+
+def test_outbox_records_refused_recipient(smtp_server):
+    smtp_server.reject_recipients = {'bad@example.com'}
+    bad_id, good_id = enqueue('bad@example.com', 'good@example.com')
+    lottery.process_outbox()
+
+    bad = get_message(bad_id)
+    assert (bad.status, bad.attempts) == ('pending', 1)
+    assert 'No such user' in bad.last_error
+    assert get_message(good_id).status == 'pending'
+
+    lottery.process_outbox()
+    assert get_message(good_id).status == 'sent'
+    assert [m['to'] for m in smtp_server.messages] == [['good@example.com']]
+
+
+def test_outbox_server_unreachable_keeps_batch_queued(smtp_server):
+    smtp_server.stop()
+    first_id, second_id = enqueue('a@example.com', 'b@example.com')
+    lottery.process_outbox()
+
+    first = get_message(first_id)
+    assert (first.status, first.attempts) == ('pending', 1)
+    assert first.last_error
+    assert (get_message(second_id).status, get_message(second_id).attempts) == ('pending', 0)
+
+
+def test_outbox_backoff_doubles_and_gives_up(smtp_server):
+    smtp_server.data_reply = '554 Message rejected'
+    message_id, = enqueue('a@example.com')
+    delays = []
+    for _ in range(lottery.MAIL_MAX_ATTEMPTS):
+        message = make_due(message_id)
+        started = datetime.now()
+        lottery.process_outbox()
+        if message.status == 'pending':
+            delays.append(round((message.next_attempt_at - started).total_seconds()))
+
+    assert delays == [lottery.MAIL_RETRY_BASE_SECONDS * 2 ** n for n in range(lottery.MAIL_MAX_ATTEMPTS - 1)]
+    assert (message.status, message.attempts) == ('failed', lottery.MAIL_MAX_ATTEMPTS)
+    assert 'Message rejected' in message.last_error
+    assert lottery.process_outbox() is False
+    assert smtp_server.messages == []
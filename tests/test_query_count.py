@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy import event
+
+from conftest import lottery, make_draw
+
+
+def count_queries(client, path):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(lottery.db.engine, 'before_cursor_execute', record)
+    try:
+        assert client.get(path).status_code == 200
+    finally:
+        event.remove(lottery.db.engine, 'before_cursor_execute', record)
+    return len(statements)
+
+
+@pytest.mark.parametrize('draws', [0, 3, 10])
+def test_index_query_count_is_constant(client, monkeypatch, draws):
+    monkeypatch.setattr(lottery, 'SETTINGS_CHECK_SECONDS', 3600)
+    for i in range(draws):
+        # Trộn đợt sắp diễn ra, đang quay và đã có người thắng để trang chủ hiển thị đủ các trạng thái
+        draw = make_draw(2, started=i % 3 != 0)
+        if i % 3 == 2:
+            lottery.elect_winners(draw)
+    client.get('/')
+
+    assert count_queries(client, '/') == 1
@@ -0,0 +1,29 @@
+import pytest
+
+from conftest import lottery
+
+
+def test_serverless_without_secret_key_fails_at_startup(monkeypatch, tmp_path):
+    monkeypatch.setattr(lottery, 'SERVERLESS', True)
+    monkeypatch.setattr(lottery, 'SECRET_KEY_FILE', str(tmp_path / 'secret_key'))
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    with pytest.raises(RuntimeError, match='SECRET_KEY'):
+        lottery.load_secret_keys()
+    assert not (tmp_path / 'secret_key').exists()
+
+
+def test_serverless_uses_configured_secret_key(monkeypatch):
+    monkeypatch.setattr(lottery, 'SERVERLESS', True)
+    monkeypatch.setenv('SECRET_KEY', 'from-env')
+    monkeypatch.setenv('SECRET_KEY_FALLBACKS', 'old-1,old-2')
+    assert lottery.load_secret_keys() == ('from-env', ['old-1', 'old-2'])
+
+
+def test_server_creates_shared_key_file(monkeypatch, tmp_path):
+    key_file = tmp_path / 'secret_key'
+    monkeypatch.setattr(lottery, 'SERVERLESS', False)
+    monkeypatch.setattr(lottery, 'SECRET_KEY_FILE', str(key_file))
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    key, fallbacks = lottery.load_secret_keys()
+    assert key_file.read_text().strip() == key
+    assert lottery.load_secret_keys() == (key, fallbacks)
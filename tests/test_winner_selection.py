@@ -0,0 +1,62 @@
+import random
+from collections import Counter
+
+from conftest import lottery, make_draw
+
+PARTICIPANTS = 20
+PICKS = 10000
+# Ngưỡng chi-square với 19 bậc tự do ở mức p = 0.001
+CHI_SQUARE_CRITICAL = 43.82
+
+
+def test_pick_random_participant_is_uniform(app_ctx):
+    draw = make_draw(PARTICIPANTS)
+    random.seed(2024)
+    counts = Counter(lottery.pick_random_participant(draw.id).id for _ in range(PICKS))
+
+    assert len(counts) == PARTICIPANTS
+    expected = PICKS / PARTICIPANTS
+    chi_square = sum((observed - expected) ** 2 / expected for observed in counts.values())
+    assert chi_square < CHI_SQUARE_CRITICAL
+
+
+def test_pick_random_participant_empty_draw(app_ctx):
+    draw = make_draw()
+    assert lottery.pick_random_participant(draw.id) is None
+
+
+def test_pick_random_participant_ignores_other_draws(app_ctx):
+    draw = make_draw(3)
+    other = make_draw(3)
+    picked = {lottery.pick_random_participant(draw.id).draw_id for _ in range(50)}
+    assert picked == {draw.id}
+    assert other.id not in picked
+
+
+def test_upcoming_draw_is_not_elected_early(client):
+    draw = make_draw(10)
+
+    response = client.get(f'/get-winner/{draw.id}')
+    assert response.status_code == 409
+    assert response.json == {'error': 'Draw has not started'}
+    assert client.get(f'/spin/{draw.id}/events').status_code == 409
+    assert lottery.resolve_winner(draw.id) is None
+
+    lottery.db.session.refresh(draw)
+    assert draw.winner_id is None
+    assert draw.status == 'Sắp diễn ra'
+
+
+def test_started_draw_is_elected(client):
+    draw = make_draw(10, started=True)
+
+    response = client.get(f'/get-winner/{draw.id}')
+    assert response.status_code == 200
+    lottery.db.session.refresh(draw)
+    assert response.json['winning_number'] == draw.winning_number
+
+
+def test_unknown_draw_returns_json_404(client):
+    response = client.get('/get-winner/999')
+    assert response.status_code == 404
+    assert response.json == {'error': 'Draw not found'}
@@ -0,0 +1,4 @@
+# Điểm vào WSGI cho môi trường production: gunicorn -c gunicorn.conf.py wsgi:app
+from app import create_app
+
+app = create_app()